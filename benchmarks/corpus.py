@@ -0,0 +1,64 @@
+"""Synthetic chat corpora used by the benchmarks.
+
+The messages are made of Portuguese-like words drawn from a Zipf distribution,
+which is close enough to real chat for the shape of the Markov chain: a few
+very common words with thousands of followers and a long tail of rare ones.
+"""
+from __future__ import annotations
+import typing as t
+
+import itertools
+import random
+
+__all__ = (
+    "make_vocabulary",
+    "generate_messages",
+)
+
+
+COMMON_WORDS: t.Final[t.Tuple[str, ...]] = (
+    "de", "que", "o", "a", "e", "do", "da", "em", "um", "para",
+    "com", "não", "uma", "os", "no", "se", "na", "por", "mais", "as",
+    "mas", "eu", "tu", "ele", "você", "isso", "tá", "kkkk", "mano", "né",
+)  # fmt: skip
+
+SYLLABLES: t.Final[t.Tuple[str, ...]] = (
+    "a", "ba", "ca", "ça", "da", "de", "di", "do", "e", "fa", "fi", "ga",
+    "go", "gu", "i", "ja", "la", "le", "li", "lo", "lha", "ma", "me", "mi",
+    "mo", "na", "ne", "nho", "o", "pa", "pe", "po", "que", "ra", "re", "ri",
+    "ro", "sa", "se", "so", "ta", "te", "ti", "to", "tu", "va", "ve", "vi",
+    "ção", "ões", "ão", "zi",
+)  # fmt: skip
+
+
+def make_vocabulary(size: int, *, rng: random.Random) -> list[str]:
+    """Makes `size` distinct words, the most common ones first."""
+    words = list(COMMON_WORDS[:size])
+    seen = set(words)
+
+    while len(words) < size:
+        n_syllables = rng.choice((1, 2, 2, 3, 3, 3, 4))
+        word = "".join(rng.choice(SYLLABLES) for _ in range(n_syllables))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    return words
+
+
+def generate_messages(
+    n_messages: int,
+    *,
+    vocabulary_size: int = 20_000,
+    min_words: int = 2,
+    max_words: int = 16,
+    seed: int = 0,
+) -> t.Iterator[str]:
+    """Yields `n_messages` lowercased chat messages, always the same ones for a seed."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng=rng)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary_size + 1)))
+
+    for _ in range(n_messages):
+        length = rng.randint(min_words, max_words)
+        yield " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=length))
@@ -0,0 +1,84 @@
+"""Measures the per-call overhead of the `Database` query builders.
+
+Usage: python -m benchmarks.database_builders [--iterations N]
+
+Every query shape used by the bot is built and compiled to SQL, once with the
+statement cache and once with the uncached compile functions, which build the
+SQL string on every call like the builders used to. Nothing is executed, so
+only the builder itself is measured.
+"""
+from __future__ import annotations
+import typing as t
+
+import argparse
+import contextlib
+import time
+
+from extensions.utils import database
+from extensions.utils.database import Database, DataType
+
+WARNINGS_SCHEMA: t.Final[dict[str, DataType]] = {
+    "user_id": DataType.INTEGER,
+    "author_id": DataType.INTEGER,
+    "warn_id": DataType.INTEGER,
+    "reason": DataType.TEXT,
+    "timestamp": DataType.DATETIME_NOW,
+}
+
+COMPILERS: t.Final[t.Tuple[str, ...]] = (
+    "_compile_update",
+    "_compile_delete",
+    "_compile_select",
+    "_compile_count",
+)
+
+
+def shapes(db: Database) -> dict[str, t.Callable[[int], t.Any]]:
+    return {
+        "select * where user_id": lambda i: db.select("*").where(user_id=i),
+        "count * where user_id": lambda i: db.count("*").where(user_id=i),
+        "delete where warn_id": lambda i: db.delete_where(warn_id=i),
+        "update reason where warn_id": lambda i: db.update(reason="r").where(warn_id=i),
+    }
+
+
+@contextlib.contextmanager
+def uncached() -> t.Iterator[None]:
+    """Swaps the cached compile functions for the functions they wrap."""
+    originals = {name: getattr(database, name) for name in COMPILERS}
+    try:
+        for name, func in originals.items():
+            setattr(database, name, func.__wrapped__)
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(database, name, func)
+
+
+def per_call(build: t.Callable[[int], t.Any], iterations: int) -> float:
+    """The average time to build and compile a query, in microseconds."""
+    start = time.perf_counter()
+    for i in range(iterations):
+        build(i)._compile()
+
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    db = Database("warns", columns=WARNINGS_SCHEMA)
+    print(f"{'shape':<30}{'uncached':>12}{'cached':>12}{'change':>10}")
+    for name, build in shapes(db).items():
+        with uncached():
+            before = per_call(build, args.iterations)
+
+        after = per_call(build, args.iterations)
+        change = (after - before) / before * 100
+        print(f"{name:<30}{before:>10.3f}µs{after:>10.3f}µs{change:>+9.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compares the memory used by the old and new Markov chain representations.
+
+Usage: python -m benchmarks.markov_memory [--messages N] [--db PATH]
+
+The legacy representation is the `defaultdict[str, list[str]]` built by the old
+`MarkovModel._create_chain`, the new one is the array-backed `Chain`. Both are
+built from the same corpus, either synthetic or read from a markov database.
+"""
+from __future__ import annotations
+import typing as t
+
+from collections import defaultdict
+import argparse
+import sqlite3
+import tracemalloc
+
+from extensions.utils.chain import ChainBuilder
+
+from .corpus import generate_messages
+
+
+def build_legacy_chain(messages: t.Iterable[str]) -> defaultdict[str, list[str]]:
+    words: list[str] = []
+    for msg in messages:
+        words.extend(msg.split(" "))
+
+    chain: defaultdict[str, list[str]] = defaultdict(list)
+    for current_state, next_word in zip(words, words[1:]):
+        if next_word not in chain[current_state]:
+            chain[current_state].append(next_word)
+
+    return chain
+
+
+def build_chain(messages: t.Iterable[str]) -> t.Any:
+    builder = ChainBuilder(state_size=1)
+    for msg in messages:
+        builder.feed(msg.split())
+
+    return builder.build()
+
+
+def measure(builder: t.Callable[[list[str]], t.Any], messages: list[str]) -> int:
+    """The memory still held by what `builder` returns, in bytes."""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = builder(messages)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    del result
+    return after - before
+
+
+def load_messages(path: str) -> list[str]:
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT message FROM messages")]
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--db", help="read the corpus from this markov database")
+    args = parser.parse_args()
+
+    if args.db:
+        messages = load_messages(args.db)
+    else:
+        messages = list(generate_messages(args.messages))
+
+    n_words = sum(len(msg.split()) for msg in messages)
+    print(f"corpus: {len(messages)} messages, {n_words} words")
+
+    legacy = measure(build_legacy_chain, messages)
+    packed = measure(build_chain, messages)
+
+    print(f"{'dict of lists (legacy)':<26}{legacy / 2**20:>10.2f} MiB")
+    print(f"{'interned arrays (Chain)':<26}{packed / 2**20:>10.2f} MiB")
+    if packed:
+        print(f"{'reduction':<26}{legacy / packed:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Measures how the Markov engine scales with the size of the corpus.
+
+Usage: python -m benchmarks.markov_suite [--sizes N ...] [--output PATH] [--compare PATH]
+
+For every corpus size a synthetic corpus is stored in a markov database inside
+a temporary `data/` directory, then `MarkovModel._create_chain`,
+`MarkovModel._generate_text`, `MarkovDB.fetch_messages` and the streamed
+`MarkovModel.load_chain` are measured. The results are printed and, with
+`--output`, written as JSON so that a later run can be compared against them
+with `--compare`. Nothing touches the network or the real `data/` directory.
+"""
+from __future__ import annotations
+import typing as t
+
+import argparse
+import asyncio
+import datetime
+import json
+import pathlib
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from extensions.utils.markov import ChainCache, MarkovDB, MarkovModel
+from extensions.utils.tokenizer import tokenize
+
+from .corpus import generate_messages
+
+DEFAULT_SIZES: t.Final[t.Tuple[int, ...]] = (1_000, 10_000, 100_000, 1_000_000)
+INSERT_BATCH: t.Final[int] = 5_000
+
+# Metrics where a lower value is better, in the order they are printed
+METRICS: t.Final[t.Tuple[str, ...]] = (
+    "insert_seconds",
+    "build_seconds",
+    "build_peak_bytes",
+    "fetch_seconds",
+    "fetch_peak_bytes",
+    "load_seconds",
+    "load_peak_bytes",
+    "generate_p50_ms",
+    "generate_p90_ms",
+    "generate_p99_ms",
+    "db_bytes",
+)
+
+
+def peak_memory(func: t.Callable[[], t.Any]) -> int:
+    """The peak memory allocated while running `func`, in bytes."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+def timed(func: t.Callable[[], t.Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def percentile(samples: t.Sequence[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def database_size(path: pathlib.Path) -> int:
+    files = (path, path.with_name(path.name + "-wal"), path.with_name(path.name + "-shm"))
+    return sum(file.stat().st_size for file in files if file.exists())
+
+
+async def fill_database(db: MarkovDB, messages: t.Iterable[str]) -> int:
+    stored = 0
+    async with db:
+        batch: list[str] = []
+        for msg in messages:
+            batch.append(msg)
+            if len(batch) >= INSERT_BATCH:
+                await db.add_messages(batch)
+                stored += len(batch)
+                batch.clear()
+
+        await db.add_messages(batch)
+        stored += len(batch)
+
+    return stored
+
+
+async def fetch_all(db: MarkovDB) -> int:
+    async with db:
+        messages = await db.fetch_messages()
+
+    return len(messages or ())
+
+
+async def sample_generation(
+    model: MarkovModel,
+    seeds: t.Sequence[str],
+    n_words: int,
+) -> list[float]:
+    """Latency of `_generate_text` for every seed, in milliseconds."""
+    latencies: list[float] = []
+    async with model.db as db:
+        for seed in seeds:
+            words = tokenize(seed)
+            start = time.perf_counter()
+            chain = model._create_chain(words, model.state_size)
+            await model._generate_text(db, chain, n_words, words)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    return latencies
+
+
+def run_size(
+    n_messages: int,
+    *,
+    state_size: int,
+    samples: int,
+    n_words: int,
+    seed: int,
+) -> dict[str, t.Any]:
+    messages = list(generate_messages(n_messages, seed=seed))
+    words = [word for msg in messages for word in msg.split()]
+
+    with tempfile.TemporaryDirectory(prefix="markov-bench-") as tmp:
+        path = pathlib.Path(tmp, "data", "markov.db")
+        path.parent.mkdir()
+        db = MarkovDB(path, state_size=state_size)
+        model = MarkovModel(db, cache=ChainCache())
+
+        start = time.perf_counter()
+        asyncio.run(fill_database(db, messages))
+        insert_seconds = time.perf_counter() - start
+
+        # Timing and memory are measured in separate runs, tracing the
+        # allocations slows everything down.
+        build = lambda: model._create_chain(words, state_size)  # noqa: E731
+        fetch = lambda: asyncio.run(fetch_all(db))  # noqa: E731
+        load = lambda: asyncio.run(model.load_chain())  # noqa: E731
+
+        rng = random.Random(seed)
+        seeds = rng.choices(messages, k=samples)
+        latencies = asyncio.run(sample_generation(model, seeds, n_words))
+
+        result = {
+            "messages": n_messages,
+            "words": len(words),
+            "insert_seconds": insert_seconds,
+            "build_seconds": timed(build),
+            "build_peak_bytes": peak_memory(build),
+            "fetch_seconds": timed(fetch),
+            "fetch_peak_bytes": peak_memory(fetch),
+            "load_seconds": timed(load),
+            "load_peak_bytes": peak_memory(load),
+            "generate_p50_ms": percentile(latencies, 50),
+            "generate_p90_ms": percentile(latencies, 90),
+            "generate_p99_ms": percentile(latencies, 99),
+            "generate_mean_ms": statistics.fmean(latencies),
+            "db_bytes": database_size(path),
+        }
+        model.close()
+
+    return result
+
+
+def format_value(metric: str, value: float) -> str:
+    if metric.endswith("_bytes"):
+        return f"{value / 2**20:.2f} MiB"
+    if metric.endswith("_seconds"):
+        return f"{value:.3f} s"
+    return f"{value:.3f} ms"
+
+
+def print_results(results: list[dict[str, t.Any]]) -> None:
+    for result in results:
+        print(f"\n{result['messages']} messages, {result['words']} words")
+        for metric in METRICS:
+            print(f"  {metric:<20}{format_value(metric, result[metric]):>14}")
+
+
+def print_comparison(
+    baseline: list[dict[str, t.Any]],
+    results: list[dict[str, t.Any]],
+) -> None:
+    previous = {result["messages"]: result for result in baseline}
+    for result in results:
+        old = previous.get(result["messages"])
+        if old is None:
+            continue
+
+        print(f"\n{result['messages']} messages (baseline -> current)")
+        for metric in METRICS:
+            before, after = old.get(metric), result[metric]
+            if not before:
+                continue
+
+            change = (after - before) / before * 100
+            print(
+                f"  {metric:<20}{format_value(metric, before):>14}"
+                f"{format_value(metric, after):>14}{change:>+9.1f}%"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--state-size", type=int, default=1)
+    parser.add_argument("--samples", type=int, default=200, help="generations per size")
+    parser.add_argument("--words", type=int, default=20, help="words per generation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results of a previous run")
+    args = parser.parse_args()
+
+    results: list[dict[str, t.Any]] = []
+    for size in args.sizes:
+        print(f"running {size} messages...", file=sys.stderr)
+        results.append(
+            run_size(
+                size,
+                state_size=args.state_size,
+                samples=args.samples,
+                n_words=args.words,
+                seed=args.seed,
+            )
+        )
+
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+
+        print_comparison(baseline["results"], results)
+
+    if args.output:
+        report = {
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {
+                "state_size": args.state_size,
+                "samples": args.samples,
+                "words": args.words,
+                "seed": args.seed,
+            },
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Measures warn lookups on a large warns table, with and without its indexes.
+
+Usage: python -m benchmarks.warns_indexes [--rows N] [--lookups N]
+
+A warns table is filled with synthetic warns inside a temporary `data/`
+directory, then the lookups made by the moderation commands, by user and by
+warn id, are timed through `Database`. The indexes are then created and the
+same lookups are timed again. Nothing touches the real `data/` directory.
+"""
+from __future__ import annotations
+import typing as t
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from extensions.utils.database import Database, Index, close_pools
+
+from .database_builders import WARNINGS_SCHEMA
+
+WARNINGS_INDEXES: t.Final[t.Tuple[Index, ...]] = (
+    Index(("user_id",)),
+    Index(("warn_id",)),
+)
+USERS: t.Final[int] = 20_000
+
+
+def generate_warns(rows: int, *, seed: int) -> t.Iterator[dict[str, t.Any]]:
+    rng = random.Random(seed)
+    for warn_id in rng.sample(range(100_000_000), rows):
+        yield {
+            "user_id": rng.randrange(USERS),
+            "author_id": rng.randrange(100),
+            "warn_id": warn_id,
+            "reason": "Motivo não informado",
+        }
+
+
+async def query_plan(db: Database, query: str) -> str:
+    async with db._conn.cursor() as cr:
+        await cr.execute(f"EXPLAIN QUERY PLAN {query}", 0)
+        return "; ".join(row[3] for row in await cr.fetchall())
+
+
+async def time_lookups(
+    db: Database,
+    user_ids: t.Sequence[int],
+    warn_ids: t.Sequence[int],
+) -> dict[str, float]:
+    """The average time of every lookup, in milliseconds."""
+    lookups: dict[str, t.Callable[[int], t.Any]] = {
+        "select by user_id": lambda i: db.select("*").where(user_id=i).execute(),
+        "count by user_id": lambda i: db.count("*").where(user_id=i).execute(),
+        "select by warn_id": lambda i: db.select("*").where(warn_id=i).execute(),
+    }
+
+    results: dict[str, float] = {}
+    for name, lookup in lookups.items():
+        ids = warn_ids if name.endswith("warn_id") else user_ids
+        start = time.perf_counter()
+        for i in ids:
+            await lookup(i)
+
+        results[name] = (time.perf_counter() - start) / len(ids) * 1000
+
+    return results
+
+
+async def run(rows: int, lookups: int, seed: int) -> None:
+    rng = random.Random(seed)
+    user_ids = [rng.randrange(USERS) for _ in range(lookups)]
+
+    async with Database("warns", columns=WARNINGS_SCHEMA) as db:
+        start = time.perf_counter()
+        await db.insert_many(generate_warns(rows, seed=seed))
+        print(f"inserted {rows} warns in {time.perf_counter() - start:.2f}s")
+
+        rows_sample = await db.select("warn_id").execute()
+        warn_ids = [row[0] for row in rng.sample(rows_sample, lookups)]
+        del rows_sample
+
+        before = await time_lookups(db, user_ids, warn_ids)
+        plan_before = await query_plan(db, "SELECT * FROM warns WHERE user_id = ?")
+
+    start = time.perf_counter()
+    async with Database("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES) as db:
+        print(f"created the indexes in {time.perf_counter() - start:.2f}s")
+        after = await time_lookups(db, user_ids, warn_ids)
+        plan_after = await query_plan(db, "SELECT * FROM warns WHERE user_id = ?")
+
+    await close_pools()
+
+    print(f"\n{'lookup':<22}{'no index':>14}{'indexed':>14}{'speedup':>10}")
+    for name, old in before.items():
+        new = after[name]
+        print(f"{name:<22}{old:>11.3f} ms{new:>11.3f} ms{old / new:>9.1f}x")
+
+    print(f"\nplan without indexes: {plan_before}")
+    print(f"plan with indexes:    {plan_after}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200, help="lookups per kind")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="warns-bench-") as tmp:
+        os.chdir(tmp)
+        os.mkdir("data")
+        try:
+            asyncio.run(run(args.rows, args.lookups, args.seed))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ import discord
 import logging
 
 from extensions.utils.image import predominant_color_on
+from extensions.utils.database import close_pools
 from extensions.utils.context import Context
 from extensions.help import PaginatedHelp
 
@@ -99,6 +100,12 @@ class Utopify(LoggedBot):
         members = self.bot_app_info.team.members
         return discord.utils.get(members, id=self.owner_id)
 
+    async def close(self) -> None:
+        try:
+            return await super().close()
+        finally:
+            await close_pools()
+
     async def setup_hook(self) -> None:
         PAINEL_ID = 794456288306266122
 
@@ -167,8 +174,11 @@ class Utopify(LoggedBot):
         await self._painel_channel.send(self.owner.mention, embed=embed)
 
 
-bot = Utopify()
-bot.run(
-    token=dotenv_get("TOKEN"),
-    log_level=logging.INFO,
-)
+# Guarded since the processes spawned for the Markov executor import the main
+# module again
+if __name__ == "__main__":
+    bot = Utopify()
+    bot.run(
+        token=dotenv_get("TOKEN"),
+        log_level=logging.INFO,
+    )
@@ -2,31 +2,80 @@ from __future__ import annotations
 import typing as t
 
 from discord.ext import commands
+from discord.ext import tasks
 from discord import ui
 import discord
 
 import datetime as dt
+import asyncio
+import sqlite3
+import time
 import re
 
-from .utils.markov import MarkovModel
+from .utils.dedup import NearDuplicateFilter
+from .utils.markov import (
+    ChainCache,
+    GenerationSkipped,
+    MarkovDB,
+    MarkovModel,
+    MarkovShards,
+)
 import functools
+import logging
 import random
 
 
 _T = t.TypeVar("_T")
 if t.TYPE_CHECKING:
     from core import Utopify
-    from collections.abc import Callable
+    from collections.abc import Callable, Coroutine
     from .utils.context import GuildContext
 
+    MarkovReply = Callable[[discord.Message], Coroutine[t.Any, t.Any, None]]
+
     FuncT = t.TypeVar("FuncT", bound=Callable[["Fun", discord.Message], t.Any])
 
+log = logging.getLogger("discord.utopiafy")
+
 
 SILENCE_VOTING_LIMIT: t.Final[int] = 5
 SILENCE_VOTING_TIME: t.Final[int] = (1 * 60) * 5
 SILENCE_TIMEOUT_TIME: t.Final[int] = (1 * 60) * 5
 SILENCE_COOLDOWN_TIME: t.Final[int] = (1 * 60) * 5
 
+# Channels the bot learns from and replies in, each one with its own model
+MARKOV_CHANNELS: t.Final[t.FrozenSet[int]] = frozenset(
+    {
+        794453931412684820,  # geladeira
+    }
+)
+MARKOV_DIRECTORY: t.Final[str] = "./data/markov"
+MARKOV_COOLDOWN_LIMIT: t.Final[int] = 52
+MARKOV_CACHE_MAX_TRANSITIONS: t.Final[int] = 250_000  # per channel
+MARKOV_FLUSH_EVERY: t.Final[int] = 50
+MARKOV_FLUSH_INTERVAL: t.Final[float] = 5.0
+MARKOV_RETENTION: t.Final[dt.timedelta] = dt.timedelta(days=1)
+MARKOV_RETENTION_INTERVAL: t.Final[int] = 30  # minutes
+MARKOV_RETENTION_CHUNK: t.Final[int] = 500
+# Storage budget of each channel, enforced more often than the retention so
+# a raid can't make replies slower until the next retention pass
+MARKOV_MAX_MESSAGES: t.Final[int] = 50_000
+MARKOV_MAX_BYTES: t.Final[int] = 64 * 1024 * 1024
+MARKOV_BUDGET_INTERVAL: t.Final[int] = 5  # minutes
+MARKOV_EXECUTOR: t.Final[t.Literal["inline", "thread", "process"]] = "inline"
+MARKOV_MAX_GENERATIONS: t.Final[int] = 2
+MARKOV_GENERATION_TIMEOUT: t.Final[float] = 3.0
+MARKOV_CANDIDATES: t.Final[int] = 4
+MARKOV_DEDUP_WINDOW: t.Final[int] = 5_000  # messages
+MARKOV_QUEUE_SIZE: t.Final[int] = 1_000  # messages waiting to be learned
+MARKOV_POOL_SIZE: t.Final[int] = 20
+MARKOV_POOL_LOW_WATER: t.Final[int] = 5
+# History imports page through the channel in time windows, a few at a time
+MARKOV_IMPORT_WINDOW: t.Final[dt.timedelta] = dt.timedelta(hours=6)
+MARKOV_IMPORT_CONCURRENCY: t.Final[int] = 4
+MARKOV_IMPORT_BATCH: t.Final[int] = 1_000
+MARKOV_IMPORT_PROGRESS_INTERVAL: t.Final[float] = 5.0  # seconds
+
 
 def markov_cooldown(
     rate: int,
@@ -153,9 +202,73 @@ class Fun(commands.Cog, name="Diversão"):
     """Comandos de diversão"""
 
     def __init__(self, bot: Utopify) -> None:
-        self._message_markov_cooldown: int = 0
+        self._message_markov_cooldown: t.Dict[int, int] = {}
         self.bot: Utopify = bot
 
+        # Messages are learned by a background worker, the listener only
+        # decides whether they should be and whether to reply
+        self._markov_queue: asyncio.Queue[t.Optional[discord.Message]] = asyncio.Queue(
+            maxsize=MARKOV_QUEUE_SIZE
+        )
+        self._markov_worker: t.Optional[asyncio.Task[None]] = None
+        self._markov_prefixes = self._static_prefixes()
+        self._markov_queue_dropped = 0
+        self._markov_listener_calls = 0
+        self._markov_listener_ns = 0
+
+        self.markov_channels: t.Set[int] = set(MARKOV_CHANNELS)
+        self._markov_imports: t.Set[int] = set()
+        self.markov = MarkovShards(
+            MARKOV_DIRECTORY,
+            factory=self._create_markov,
+            max_messages=MARKOV_MAX_MESSAGES,
+            max_bytes=MARKOV_MAX_BYTES,
+        )
+
+    def _create_markov(self, db: MarkovDB) -> MarkovModel:
+        return MarkovModel(
+            db,
+            cache=ChainCache(max_transitions=MARKOV_CACHE_MAX_TRANSITIONS),
+            flush_every=MARKOV_FLUSH_EVERY,
+            flush_interval=MARKOV_FLUSH_INTERVAL,
+            executor=MARKOV_EXECUTOR,
+            max_concurrency=MARKOV_MAX_GENERATIONS,
+            timeout=MARKOV_GENERATION_TIMEOUT,
+            pool_size=MARKOV_POOL_SIZE,
+            pool_low_water=MARKOV_POOL_LOW_WATER,
+            snapshot_path=db.path.with_suffix(".snapshot"),
+            candidates=MARKOV_CANDIDATES,
+            dedup=NearDuplicateFilter(window=MARKOV_DEDUP_WINDOW),
+        )
+
+    async def cog_load(self) -> None:
+        self._markov_worker = asyncio.create_task(self._markov_learner())
+        self.markov_retention.start()
+        self.markov_budget.start()
+
+    async def cog_unload(self) -> None:
+        self.markov_retention.cancel()
+        self.markov_budget.cancel()
+
+        # Let the worker learn whatever is still queued before flushing
+        if self._markov_worker is not None:
+            await self._markov_queue.put(None)
+            await self._markov_worker
+
+        await self.markov.flush()
+        self.markov.close()
+
+    def _static_prefixes(self) -> t.Optional[t.Tuple[str, ...]]:
+        """The bot's prefixes, or None if they depend on the message."""
+        prefix = self.bot.command_prefix
+        if isinstance(prefix, str):
+            return (prefix,)
+
+        if isinstance(prefix, (list, tuple)):
+            return tuple(prefix)
+
+        return None
+
     @property
     def display_emoji(self) -> discord.PartialEmoji:
         return discord.PartialEmoji(name="\N{ROLLING ON THE FLOOR LAUGHING}")
@@ -248,12 +361,194 @@ class Fun(commands.Cog, name="Diversão"):
         answer = random.choice(answers)
         await ctx.reply(f"> {answer}")
 
+    @commands.command(
+        name="markovstats",
+        help="Mostra quantas mensagens repetidas o markov descartou",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def markov_stats(self, ctx: GuildContext) -> None:
+        lines = []
+        if self._markov_listener_calls:
+            average = self._markov_listener_ns / self._markov_listener_calls / 1000
+            lines.append(
+                f"> Listener: `{average:.1f}µs` por mensagem, "
+                f"`{self._markov_queue_dropped}` descartadas com a fila cheia"
+            )
+
+        for channel_id in sorted(self.markov_channels):
+            if channel_id not in self.markov:
+                lines.append(f"> <#{channel_id}>: nada aprendido desde que liguei")
+                continue
+
+            dedup = self.markov.get(channel_id).dedup
+            assert dedup is not None
+            lines.append(
+                f"> <#{channel_id}>: `{dedup.dropped}` de `{dedup.checked}` mensagens descartadas"
+            )
+
+        await ctx.reply("\n".join(lines) or "> Nenhum canal configurado")
+
+    @commands.command(
+        name="markovimport",
+        help="Ensina ao markov o histórico de um canal, continuando de onde parou",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def markov_import(
+        self,
+        ctx: GuildContext,
+        channel: discord.TextChannel,
+        hours: t.Optional[int] = None,
+    ) -> None:
+        if channel.id not in self.markov_channels:
+            return await ctx.reply("> Esse canal não é um canal do markov")
+
+        # Anything older than the retention would be deleted on its next pass
+        max_hours = int(MARKOV_RETENTION.total_seconds() // 3600)
+        if hours is None:
+            hours = max_hours
+        elif not 0 < hours <= max_hours:
+            return await ctx.reply(
+                f"> Só dá pra importar até `{max_hours}` horas, o markov esquece o resto"
+            )
+
+        if channel.id in self._markov_imports:
+            return await ctx.reply("> Já estou importando esse canal")
+
+        markov = self.markov.get(channel.id)
+        # The range is kept along with the progress, so a resumed import
+        # doesn't learn twice what was learned live since the first run
+        start = await markov.get_metadata("import_start")
+        end = await markov.get_metadata("import_end")
+        resumed = start is not None and end is not None
+        now = discord.utils.utcnow()
+        if not resumed:
+            # The channel has been learning live, so what the shard already
+            # holds would be learned twice, the import stops where it begins
+            oldest = await markov.oldest_message()
+            start = discord.utils.time_snowflake(now - dt.timedelta(hours=hours))
+            end = discord.utils.time_snowflake(min(oldest, now) if oldest else now)
+            await markov.set_metadata("import_start", start)
+            await markov.set_metadata("import_end", end)
+
+        step = int(MARKOV_IMPORT_WINDOW.total_seconds() * 1000) << 22
+        windows = [(after, min(after + step, end)) for after in range(start, end, step)]
+        # The last message learned from each window, under a key of its own so
+        # windows running at once never overwrite each other's progress
+        progress_keys = [f"import_progress_{i}" for i in range(len(windows))]
+        progress = [
+            (await markov.get_metadata(key) if resumed else None) or 0
+            for key in progress_keys
+        ]
+        # What a late resume would import has been forgotten already
+        forgotten = discord.utils.time_snowflake(now - MARKOV_RETENTION)
+        finished = scanned = stored = 0
+
+        status = await ctx.reply(
+            f"> {'Continuando' if resumed else 'Começando'} a importação de {channel.mention}..."
+        )
+        last_update = time.monotonic()
+
+        async def update_status(final: bool = False) -> None:
+            nonlocal last_update
+            if not final and time.monotonic() - last_update < MARKOV_IMPORT_PROGRESS_INTERVAL:
+                return
+
+            last_update = time.monotonic()
+            done = finished / len(windows) if windows else 1.0
+            state = "Importação concluída" if final else "Importando"
+            await status.edit(
+                content=f"> {state} em {channel.mention}: `{done:.0%}`, "
+                f"`{stored}` de `{scanned}` mensagens aprendidas"
+            )
+
+        semaphore = asyncio.Semaphore(MARKOV_IMPORT_CONCURRENCY)
+
+        async def store(
+            index: int,
+            batch: list[str],
+            timestamps: list[dt.datetime],
+            last_id: int,
+        ) -> None:
+            nonlocal stored
+            # The progress is saved along with the batch, so a resume never
+            # learns a message twice
+            count = await markov.import_messages(
+                batch,
+                timestamps=timestamps,
+                metadata={progress_keys[index]: last_id},
+            )
+            stored += count
+
+        async def import_window(index: int) -> None:
+            nonlocal finished, scanned
+            after, before = windows[index]
+            after = max(after, progress[index], forgotten)
+            if after >= before:
+                finished += 1
+                return
+
+            async with semaphore:
+                batch: list[str] = []
+                timestamps: list[dt.datetime] = []
+                # `before` is exclusive, so the window ends right at its bound
+                async for message in channel.history(
+                    limit=None,
+                    after=discord.Object(after),
+                    before=discord.Object(before + 1),
+                    oldest_first=True,
+                ):
+                    scanned += 1
+                    if self._is_learnable(message) and not await self._is_command(message):
+                        batch.append(message.content)
+                        timestamps.append(message.created_at)
+
+                    if len(batch) >= MARKOV_IMPORT_BATCH:
+                        await store(index, batch, timestamps, message.id)
+                        batch.clear()
+                        timestamps.clear()
+                        await update_status()
+
+                await store(index, batch, timestamps, before)
+
+            finished += 1
+            await update_status()
+
+        self._markov_imports.add(channel.id)
+        window_tasks = [asyncio.create_task(import_window(i)) for i in range(len(windows))]
+        try:
+            await asyncio.gather(*window_tasks)
+        except Exception:
+            for task in window_tasks:
+                task.cancel()
+
+            await status.edit(
+                content=f"> A importação de {channel.mention} falhou, "
+                "use o comando de novo para continuar de onde parou"
+            )
+            raise
+        finally:
+            self._markov_imports.discard(channel.id)
+
+        for key in ("import_start", "import_end", *progress_keys):
+            await markov.set_metadata(key, None)
+        await update_status(final=True)
+
     @markov_cooldown(1, 5)
     async def markov_by_mention(self, message: discord.Message) -> None:
-        model = MarkovModel()
         n_words = random.randint(6, 12)
+        markov = self.markov.get(message.channel.id)
+
+        # The raw content is used since the tokenizer drops mentions, so the
+        # bot's own mention doesn't get in the way of seeding the reply
+        try:
+            msg = await markov.pooled_text(message.content, n_words)
+        # A shard with nothing written yet has no entries, or no file at all
+        except (GenerationSkipped, ValueError, sqlite3.OperationalError) as e:
+            log.debug("Skipping markov reply: %s", e)
+            return
 
-        msg = await model.generate_text(message.clean_content, n_words)
         await message.reply(
             content=msg,
             allowed_mentions=discord.AllowedMentions(
@@ -264,10 +559,15 @@ class Fun(commands.Cog, name="Diversão"):
         )
 
     async def markov_by_cooldown(self, message: discord.Message) -> None:
-        model = MarkovModel()
         n_words = random.randint(6, 12)
+        markov = self.markov.get(message.channel.id)
+
+        try:
+            msg = await markov.pooled_text("", n_words)
+        except (GenerationSkipped, ValueError, sqlite3.OperationalError) as e:
+            log.debug("Skipping markov reply: %s", e)
+            return
 
-        msg = await model.generate_text(message.clean_content, n_words)
         await message.reply(
             content=msg,
             allowed_mentions=discord.AllowedMentions(
@@ -277,47 +577,121 @@ class Fun(commands.Cog, name="Diversão"):
             ),
         )
 
-    async def markov_learn(self, message: discord.Message) -> None:
-        assert self.bot.user is not None
-        assert message.guild is not None
+    def _is_learnable(self, message: discord.Message) -> bool:
+        """Whether a message should be learned, as far as it can be told without awaiting.
 
-        if message.is_system():
-            return
+        Messages starting with a prefix that depends on the message are only
+        caught by `_is_command`.
+        """
+        if message.author.bot or message.is_system():
+            return False
 
-        if message.author.bot:
-            return
+        prefixes = self._markov_prefixes
+        return prefixes is None or not message.content.startswith(prefixes)
+
+    async def _is_command(self, message: discord.Message) -> bool:
+        if self._markov_prefixes is not None:
+            return False  # already checked by `_is_learnable`
 
         prefix = await self.bot.get_prefix(message)
         prefix = tuple(prefix) if isinstance(prefix, list) else prefix
+        return message.content.startswith(prefix)
 
-        if message.content.startswith(prefix):
+    def markov_learn(self, message: discord.Message) -> None:
+        """Queues a message to be learned by the background worker."""
+        if not self._is_learnable(message):
             return
 
-        content = message.content.replace(f"<@{self.bot.user.id}>", "").lower()
+        try:
+            self._markov_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self._markov_queue_dropped += 1
 
-        model = MarkovModel()
-        await model.store_message(content)
+    async def _markov_learner(self) -> None:
+        while True:
+            message = await self._markov_queue.get()
+            if message is None:
+                return
 
-    @commands.Cog.listener(name="on_message")
-    async def _manage_markov(self, message: discord.Message) -> None:
+            try:
+                if await self._is_command(message):
+                    continue
+
+                await self.markov.get(message.channel.id).store_message(message.content)
+            except Exception:
+                log.exception("Failed to learn message %s", message.id)
+
+    @tasks.loop(minutes=MARKOV_RETENTION_INTERVAL)
+    async def markov_retention(self) -> None:
+        # An exception would stop the loop for good, so a channel failing
+        # (e.g. the database being locked) only skips it until the next pass
+        for channel_id in self.markov_channels:
+            try:
+                markov = self.markov.get(channel_id)
+                await markov.trim_messages(
+                    before=MARKOV_RETENTION,
+                    chunk_size=MARKOV_RETENTION_CHUNK,
+                )
+            except Exception:
+                log.exception("Failed to trim the markov messages of %s", channel_id)
+                continue
+
+            # Saved right after trimming, so a restart only replays what was
+            # learned since then. A failed snapshot only costs a longer load.
+            try:
+                await markov.save_snapshot()
+            except Exception:
+                log.exception("Failed to save the markov snapshot of %s", channel_id)
+
+    @tasks.loop(minutes=MARKOV_BUDGET_INTERVAL)
+    async def markov_budget(self) -> None:
+        for markov in self.markov:
+            try:
+                evicted = await markov.enforce_budget(chunk_size=MARKOV_RETENTION_CHUNK)
+            except Exception:
+                log.exception("Failed to enforce the budget of %s", markov.db.path)
+                continue
+
+            if evicted:
+                log.info("Evicted %s messages from %s", evicted, markov.db.path)
+
+    def _markov_prefilter(self, message: discord.Message) -> t.Optional[MarkovReply]:
+        """Queues the message to be learned and tells how to reply to it, if at all.
+
+        Runs for every message the bot sees, so nothing in here awaits.
+        """
         assert self.bot.user is not None
-        if message.author.bot:
-            return
 
-        GELADEIRA_ID = 794453931412684820
-        if message.channel.id != GELADEIRA_ID:
-            return
+        channel_id = message.channel.id
+        if channel_id not in self.markov_channels:
+            return None
+
+        if message.author.bot or message.is_system():
+            return None
 
-        await self.markov_learn(message)
+        self.markov_learn(message)
 
-        COOLDOWN_LIMIT = 52
-        self._message_markov_cooldown += 1
-        if self._message_markov_cooldown >= COOLDOWN_LIMIT:
-            self._message_markov_cooldown = 0
-            return await self.markov_by_cooldown(message)
+        count = self._message_markov_cooldown.get(channel_id, 0) + 1
+        if count >= MARKOV_COOLDOWN_LIMIT:
+            self._message_markov_cooldown[channel_id] = 0
+            return self.markov_by_cooldown
+
+        self._message_markov_cooldown[channel_id] = count
 
         if self.bot.user.mentioned_in(message):
-            return await self.markov_by_mention(message)
+            return self.markov_by_mention
+
+        return None
+
+    @commands.Cog.listener(name="on_message")
+    async def _manage_markov(self, message: discord.Message) -> None:
+        start = time.perf_counter_ns()
+        reply = self._markov_prefilter(message)
+        self._markov_listener_ns += time.perf_counter_ns() - start
+        self._markov_listener_calls += 1
+
+        if reply is not None:
+            await reply(message)
 
 
 async def setup(bot: Utopify) -> None:
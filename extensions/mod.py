@@ -12,7 +12,7 @@ from dataclasses import dataclass
 from uuid import uuid1
 
 
-from .utils.database import Database, DataType
+from .utils.database import Database, DataType, Index, open_pool, register_table
 from .utils.paginator import UtopiafyPages
 from .utils.checks import is_staff
 
@@ -30,6 +30,13 @@ WARNINGS_SCHEMA = {
     "reason": DataType.TEXT,
     "timestamp": DataType.DATETIME_NOW,
 }
+# Warns are looked up by the warned user and by their id. Old warns may share
+# an id, so that index can't be unique
+WARNINGS_INDEXES = (
+    Index(("user_id",)),
+    Index(("warn_id",)),
+)
+WARNINGS_POOL_SIZE = 2
 
 
 class WarningsSource(menus.ListPageSource):
@@ -172,6 +179,10 @@ class Mod(commands.Cog, name="Moderação"):
         LOGS_CHANNELID = 794456444681715713
         self._logs_channel = await self.bot.fetch_channel(LOGS_CHANNELID)  # type: ignore
 
+        # Closed by `Utopify.close`, after every extension is unloaded
+        await open_pool("warns", size=WARNINGS_POOL_SIZE)
+        await register_table("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES)
+
     @commands.command(
         name="user_info",
         aliases=("userinfo",),
@@ -188,7 +199,7 @@ class Mod(commands.Cog, name="Moderação"):
         if member.joined_at is None:
             return
 
-        db = Database("warns", columns=WARNINGS_SCHEMA)
+        db = Database("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES)
         async with db:
             warns_count = await db.count("*").where(user_id=ctx.author.id).execute()
 
@@ -363,7 +374,7 @@ class Mod(commands.Cog, name="Moderação"):
         *,
         reason: str = "Motivo não informado",
     ) -> None:
-        db = Database("warns", columns=WARNINGS_SCHEMA)
+        db = Database("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES)
         warn_id = hash(str(uuid1())) % 100000000
 
         async with db:
@@ -398,22 +409,24 @@ class Mod(commands.Cog, name="Moderação"):
     )
     @is_staff()
     async def remove_warn(self, ctx: GuildContext, warn_id: int) -> None:
-        db = Database("warns", columns=WARNINGS_SCHEMA)
-        async with db:
+        db = Database("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES)
+        # Only the queries run inside the transaction, it holds the write lock
+        async with db, db.transaction(immediate=True):
             removed_raw = await db.select("*").where(warn_id=warn_id).execute()
+            if len(removed_raw) == 1:
+                await db.delete_where(warn_id=warn_id).execute()
 
-            if not removed_raw:
-                await ctx.send(f"> Nenhum warn com o id *{warn_id}* foi encontrado")
-                return
+        if not removed_raw:
+            await ctx.send(f"> Nenhum warn com o id *{warn_id}* foi encontrado")
+            return
 
-            if len(removed_raw) > 1:
-                await ctx.send(
-                    f"> De alguma forma esse warn existe em 2 ou mais usuários... A Remoção foi pausada, por favor informe o desenvolvedor para prosseguir."
-                )
-                return
+        if len(removed_raw) > 1:
+            await ctx.send(
+                f"> De alguma forma esse warn existe em 2 ou mais usuários... A Remoção foi pausada, por favor informe o desenvolvedor para prosseguir."
+            )
+            return
 
-            removed = WarningPayload.from_row(removed_raw[0])
-            await db.delete_where(warn_id=warn_id).execute()
+        removed = WarningPayload.from_row(removed_raw[0])
 
         author = await ctx.guild.fetch_member(removed.author_id)
         member = await ctx.guild.fetch_member(removed.user_id)
@@ -438,7 +451,7 @@ class Mod(commands.Cog, name="Moderação"):
         help="Mostra os warns de um usuário",
     )
     async def warns(self, ctx: GuildContext, member: discord.Member) -> None:
-        db = Database("warns", columns=WARNINGS_SCHEMA)
+        db = Database("warns", columns=WARNINGS_SCHEMA, indexes=WARNINGS_INDEXES)
         async with db:
             warns_raw = await db.select("*").where(user_id=member.id).execute()
             if not warns_raw:
@@ -0,0 +1,497 @@
+"""The packed Markov chain and the snapshots it is saved to.
+
+Words are interned into integer ids and the transitions of a whole corpus are
+packed into flat arrays, so a chain costs a few bytes per transition instead of
+a Python object per state. A chain can be written to disk as a `Snapshot` and
+memory-mapped back without parsing anything.
+"""
+from __future__ import annotations
+import typing as t
+
+from array import array
+import itertools
+import bisect
+import random
+import struct
+import mmap
+import sys
+import os
+
+import pathlib
+
+try:
+    import numpy as _np
+except ImportError:  # NumPy is optional, it only speeds up sampling in bulk
+    _np = None
+
+__all__ = (
+    "Chain",
+    "ChainBuilder",
+    "FrozenVocabulary",
+    "Snapshot",
+    "State",
+    "Transitions",
+    "Vocabulary",
+    "iter_transitions",
+)
+
+_T = t.TypeVar("_T")
+
+State: t.TypeAlias = t.Tuple[str, ...]
+
+
+class Transitions:
+    """The words that may follow a state, weighted by how many times they did.
+
+    The cumulative weights are computed once and reused until the counts change,
+    so picking the next word is a binary search instead of a scan of the followers.
+    """
+
+    __slots__ = ("counts", "_words", "_cumulative")
+
+    def __init__(self, counts: t.Optional[dict[str, int]] = None) -> None:
+        self.counts: dict[str, int] = counts if counts is not None else {}
+        self._words: t.Optional[t.Tuple[str, ...]] = None
+        self._cumulative: t.Optional[list[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __repr__(self) -> str:
+        return f"<Transitions counts={self.counts!r}>"
+
+    def add(self, word: str, count: int = 1) -> None:
+        self.counts[word] = self.counts.get(word, 0) + count
+        self._cumulative = None
+
+    def merged(self, other: Transitions) -> Transitions:
+        merged = Transitions(self.counts.copy())
+        for word, count in other.counts.items():
+            merged.add(word, count)
+
+        return merged
+
+    def _weights(self) -> t.Tuple[t.Tuple[str, ...], list[int]]:
+        if self._cumulative is None:
+            self._words = tuple(self.counts.keys())
+            self._cumulative = list(itertools.accumulate(self.counts.values()))
+
+        assert self._words is not None
+        return self._words, self._cumulative
+
+    def choices(self, k: int) -> list[str]:
+        """Picks `k` next words at once, using NumPy when it's installed."""
+        words, cumulative = self._weights()
+        if _np is None or k < _NUMPY_MIN_CHOICES:
+            return random.choices(words, cum_weights=cumulative, k=k)
+
+        points = _np.random.randint(cumulative[-1], size=k)
+        indexes = _np.searchsorted(cumulative, points, side="right")
+        return [words[index] for index in indexes.tolist()]
+
+
+# Below this, converting to and from NumPy arrays costs more than it saves
+_NUMPY_MIN_CHOICES: t.Final[int] = 8
+
+
+def iter_transitions(
+    words: t.Sequence[_T],
+    state_size: int,
+) -> t.Iterator[t.Tuple[t.Tuple[_T, ...], _T]]:
+    for i in range(len(words) - state_size):
+        yield tuple(words[i : i + state_size]), words[i + state_size]
+
+
+class Vocabulary:
+    """Interns words into integer ids, so each distinct word is stored only once."""
+
+    __slots__ = ("_ids", "_words")
+
+    def __init__(self, words: t.Iterable[str] = ()) -> None:
+        self._ids: dict[str, int] = {}
+        self._words: list[str] = []
+
+        for word in words:
+            self.intern(word)
+
+    def __len__(self) -> int:
+        return len(self._words)
+
+    def __contains__(self, word: object) -> bool:
+        return word in self._ids
+
+    def __iter__(self) -> t.Iterator[str]:
+        return iter(self._words)
+
+    def intern(self, word: str) -> int:
+        word_id = self._ids.get(word)
+        if word_id is None:
+            word_id = self._ids[word] = len(self._words)
+            self._words.append(word)
+
+        return word_id
+
+    def get(self, word: str) -> t.Optional[int]:
+        return self._ids.get(word)
+
+    def word(self, word_id: int) -> str:
+        return self._words[word_id]
+
+
+class FrozenVocabulary:
+    """A read-only `Vocabulary` packed into a single UTF-8 buffer.
+
+    Words are sorted by their encoded bytes, a word's id is its position and
+    looking a word up is a binary search, so no per-word object is kept alive.
+    """
+
+    __slots__ = ("_blob", "_offsets")
+
+    def __init__(self, encoded_words: t.Sequence[bytes]) -> None:
+        self._blob = b"".join(encoded_words)
+        self._offsets = array(
+            "I",
+            itertools.accumulate(map(len, encoded_words), initial=0),
+        )
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __contains__(self, word: object) -> bool:
+        return isinstance(word, str) and self.get(word) is not None
+
+    def __iter__(self) -> t.Iterator[str]:
+        return (self.word(word_id) for word_id in range(len(self)))
+
+    @classmethod
+    def _from_buffers(
+        cls, blob: t.Union[bytes, memoryview], offsets: t.Sequence[int]
+    ) -> FrozenVocabulary:
+        self = cls.__new__(cls)
+        self._blob = blob
+        self._offsets = offsets
+        return self
+
+    def __getitem__(self, word_id: int) -> bytes:
+        # The blob may be a memoryview of a snapshot, which can't be ordered
+        return bytes(self._blob[self._offsets[word_id] : self._offsets[word_id + 1]])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._blob) + self._offsets.itemsize * len(self._offsets)
+
+    def get(self, word: str) -> t.Optional[int]:
+        encoded = word.encode()
+        word_id = bisect.bisect_left(self, encoded)  # type: ignore # only needs __getitem__ and __len__
+        if word_id < len(self) and self[word_id] == encoded:
+            return word_id
+
+        return None
+
+    def word(self, word_id: int) -> str:
+        return self[word_id].decode()
+
+
+# Word ids are packed 32 bits each into a single integer per state, which fits
+# in an unsigned 64-bit array as long as states have at most two words.
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+
+
+def _pack_ids(ids: t.Iterable[int]) -> int:
+    key = 0
+    for word_id in ids:
+        key = (key << _ID_BITS) | word_id
+
+    return key
+
+
+def _unpack_ids(key: int, state_size: int) -> t.Tuple[int, ...]:
+    ids = []
+    for _ in range(state_size):
+        ids.append(key & _ID_MASK)
+        key >>= _ID_BITS
+
+    return tuple(reversed(ids))
+
+
+def _smallest_typecode(max_value: int) -> str:
+    for typecode in ("H", "I", "Q"):
+        if max_value < 1 << (array(typecode).itemsize * 8):
+            return typecode
+
+    raise OverflowError(f"{max_value} doesn't fit in an array")
+
+
+class Chain:
+    """A read-only Markov chain packed into flat arrays.
+
+    Words are interned in `vocabulary`, states are kept as sorted packed ids and the
+    followers of the i-th state live in ``followers[offsets[i]:offsets[i + 1]]``
+    next to their cumulative weights. There is no Python object per state or per
+    transition, and sampling is a binary search over the state's slice.
+
+    Use `ChainBuilder` or `Chain.from_words` to create one.
+    """
+
+    __slots__ = (
+        "vocabulary",
+        "state_size",
+        "_keys",
+        "_offsets",
+        "_followers",
+        "_cumulative",
+    )
+
+    def __init__(
+        self,
+        vocabulary: FrozenVocabulary,
+        state_size: int,
+        keys: t.Sequence[int],
+        offsets: t.Sequence[int],
+        followers: t.Sequence[int],
+        cumulative: t.Sequence[int],
+    ) -> None:
+        self.vocabulary = vocabulary
+        self.state_size = state_size
+        self._keys = keys
+        self._offsets = offsets
+        self._followers = followers
+        self._cumulative = cumulative
+
+    @classmethod
+    def from_words(cls, words: t.Sequence[str], state_size: int = 1) -> Chain:
+        builder = ChainBuilder(state_size)
+        builder.feed(words)
+        return builder.build()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, state: object) -> bool:
+        return isinstance(state, tuple) and self._find(state) is not None
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the vocabulary and transition arrays, in bytes"""
+        size = self.vocabulary.nbytes
+        for arr in (self._keys, self._offsets, self._followers, self._cumulative):
+            if isinstance(arr, (array, memoryview)):
+                size += arr.itemsize * len(arr)
+
+        return size
+
+    def _find(self, state: State) -> t.Optional[int]:
+        ids = []
+        for word in state:
+            word_id = self.vocabulary.get(word)
+            if word_id is None:
+                return None
+
+            ids.append(word_id)
+
+        key = _pack_ids(ids)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return index
+
+        return None
+
+    def get(self, state: State) -> t.Optional[Transitions]:
+        index = self._find(state)
+        if index is None:
+            return None
+
+        start, end = self._offsets[index], self._offsets[index + 1]
+        counts: dict[str, int] = {}
+        previous = 0
+        for i in range(start, end):
+            word = self.vocabulary.word(self._followers[i])
+            counts[word] = self._cumulative[i] - previous
+            previous = self._cumulative[i]
+
+        return Transitions(counts)
+
+
+class ChainBuilder:
+    """Counts the transitions of a corpus, fed message by message, into a `Chain`."""
+
+    def __init__(self, state_size: int = 1) -> None:
+        self.state_size = state_size
+        self.vocabulary = Vocabulary()
+        self._states: dict[int, dict[int, int]] = {}
+
+    def feed(self, words: t.Sequence[str]) -> None:
+        ids = [self.vocabulary.intern(word) for word in words]
+        for state, next_id in iter_transitions(ids, self.state_size):
+            followers = self._states.setdefault(_pack_ids(state), {})
+            followers[next_id] = followers.get(next_id, 0) + 1
+
+    def build(self) -> Chain:
+        # The ids given while interning follow the order words were seen, the
+        # frozen vocabulary needs them sorted so every id has to be remapped.
+        encoded = [word.encode() for word in self.vocabulary]
+        order = sorted(range(len(encoded)), key=encoded.__getitem__)
+        remap = [0] * len(order)
+        for new_id, old_id in enumerate(order):
+            remap[old_id] = new_id
+
+        states = sorted(
+            (_pack_ids(remap[i] for i in _unpack_ids(key, self.state_size)), followers)
+            for key, followers in self._states.items()
+        )
+
+        max_total = max((sum(f.values()) for _, f in states), default=0)
+        offsets = array("I", [0])
+        followers = array(_smallest_typecode(len(order)))
+        cumulative = array(_smallest_typecode(max_total))
+
+        for _, state_followers in states:
+            total = 0
+            for next_id, count in state_followers.items():
+                total += count
+                followers.append(remap[next_id])
+                cumulative.append(total)
+
+            offsets.append(len(followers))
+
+        keys: t.Sequence[int] = [key for key, _ in states]
+        if self.state_size * _ID_BITS <= 64:
+            keys = array("Q", keys)
+
+        return Chain(
+            FrozenVocabulary([encoded[i] for i in order]),
+            self.state_size,
+            keys,
+            offsets,
+            followers,
+            cumulative,
+        )
+
+
+# Snapshots start with a fixed header followed by a (typecode, length) entry per
+# section, then the sections themselves aligned to 8 bytes in native byte order.
+_SNAPSHOT_MAGIC = b"MKVS"
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct("<4sHHB7xqqq")
+_SNAPSHOT_SECTION = struct.Struct("<c7xQ")
+_SNAPSHOT_SECTIONS = 6
+
+
+def _align(size: int) -> int:
+    return -size % 8
+
+
+class Snapshot(t.NamedTuple):
+    """A packed `Chain` saved to disk, with the messages it was built from.
+
+    Loading memory-maps the file and the chain reads its arrays straight from
+    the mapping, so nothing is parsed or copied. Messages stored after the
+    snapshot, those with a rowid greater than `last_rowid`, have to be replayed
+    on top of it. `deletions` is the deletion count of the database when it
+    was saved, see `MarkovDB.deletions`.
+    """
+
+    chain: Chain
+    last_rowid: int
+    n_messages: int
+    deletions: int
+
+    def save(self, path: t.Union[str, pathlib.Path]) -> None:
+        """Writes the snapshot to a temporary file and moves it over `path`."""
+        chain = self.chain
+        if not isinstance(chain._keys, array):
+            raise ValueError(f"can't snapshot a chain with state size {chain.state_size}")
+
+        vocabulary = chain.vocabulary
+        sections = (
+            array("B", vocabulary._blob),
+            vocabulary._offsets,
+            chain._keys,
+            chain._offsets,
+            chain._followers,
+            chain._cumulative,
+        )
+
+        path = pathlib.Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as fp:
+            fp.write(
+                _SNAPSHOT_HEADER.pack(
+                    _SNAPSHOT_MAGIC,
+                    _SNAPSHOT_VERSION,
+                    chain.state_size,
+                    sys.byteorder == "little",
+                    self.last_rowid,
+                    self.n_messages,
+                    self.deletions,
+                )
+            )
+            for section in sections:
+                typecode = section.typecode.encode()  # type: ignore
+                fp.write(_SNAPSHOT_SECTION.pack(typecode, len(section)))
+
+            for section in sections:
+                data = section.tobytes()  # type: ignore
+                fp.write(data)
+                fp.write(bytes(_align(len(data))))
+
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: t.Union[str, pathlib.Path]) -> Snapshot:
+        """Memory-maps a snapshot written by `Snapshot.save`.
+
+        Raises:
+        -------
+            `ValueError`: If the file isn't a snapshot this version can read.
+        """
+        with open(path, "rb") as fp:
+            view = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+        try:
+            header = _SNAPSHOT_HEADER.unpack_from(view)
+        except struct.error:
+            raise ValueError(f"{path} is too small to be a snapshot") from None
+
+        (
+            magic,
+            version,
+            state_size,
+            little_endian,
+            last_rowid,
+            n_messages,
+            deletions,
+        ) = header
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError(f"{path} isn't a version {_SNAPSHOT_VERSION} snapshot")
+
+        if little_endian != (sys.byteorder == "little"):
+            raise ValueError(f"{path} was written with another byte order")
+
+        position = _SNAPSHOT_HEADER.size
+        layout = []
+        for _ in range(_SNAPSHOT_SECTIONS):
+            typecode, length = _SNAPSHOT_SECTION.unpack_from(view, position)
+            layout.append((typecode.decode(), length))
+            position += _SNAPSHOT_SECTION.size
+
+        sections: list[memoryview] = []
+        for typecode, length in layout:
+            size = length * array(typecode).itemsize
+            if position + size > len(view):
+                raise ValueError(f"{path} is truncated")
+
+            sections.append(view[position : position + size].cast(typecode))
+            position += size + _align(size)
+
+        blob, vocabulary_offsets, keys, offsets, followers, cumulative = sections
+        chain = Chain(
+            FrozenVocabulary._from_buffers(blob, vocabulary_offsets),
+            state_size,
+            keys,
+            offsets,
+            followers,
+            cumulative,
+        )
+        return cls(chain, last_rowid, n_messages, deletions)
@@ -2,8 +2,14 @@ from __future__ import annotations
 import typing as t
 
 import asqlite
+import asyncio
+import contextlib
+import functools
+import itertools
 import pathlib
 import inspect
+import sqlite3
+import time
 
 from enum import Enum
 
@@ -12,10 +18,27 @@ if t.TYPE_CHECKING:
 
 
 __all__ = (
+    "ConnectionPool",
     "DataType",
     "Database",
+    "Index",
+    "SchemaRegistry",
+    "close_pools",
+    "open_pool",
+    "register_table",
+    "schema_registry",
 )
 
+DEFAULT_POOL_SIZE: t.Final[int] = 2
+# Idle connections are checked before being handed out again after this long
+HEALTH_CHECK_INTERVAL: t.Final[float] = 60.0  # seconds
+# A connection whose thread stopped never answers, instead of raising
+HEALTH_CHECK_TIMEOUT: t.Final[float] = 5.0  # seconds
+# Compiled statements kept per kind of query, keyed by the shape of the query
+STATEMENT_CACHE_SIZE: t.Final[int] = 128
+# Rows sent per `executemany` when inserting from an async iterable
+INSERT_MANY_BATCH: t.Final[int] = 1_000
+
 if t.TYPE_CHECKING:
     SQLSerializable: t.TypeAlias = t.Union[t.Type[None], str, int, float, bytes]
 else:
@@ -41,6 +64,63 @@ class DataType(Enum):
     REAL = "REAL"
     TEXT = "TEXT"
 
+    @property
+    def declared_type(self) -> str:
+        """The type SQLite reports for a column of this type."""
+        return self.value.split(" ", 1)[0]
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile_insert(table_name: str, columns: t.Tuple[str, ...]) -> str:
+    placeholders = ", ".join("?" for _ in columns)
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile_update(
+    table_name: str,
+    set_columns: t.Tuple[str, ...],
+    where_columns: t.Tuple[str, ...],
+) -> str:
+    set_conditions = ", ".join(f"{column} = ?" for column in set_columns)
+    where_conditions = " AND ".join(f"{column} = ?" for column in where_columns)
+    return f"UPDATE {table_name} SET {set_conditions} WHERE {where_conditions}"
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile_delete(table_name: str, where_columns: t.Tuple[str, ...]) -> str:
+    where_conditions = " AND ".join(f"{column} = ?" for column in where_columns)
+    return f"DELETE FROM {table_name} WHERE {where_conditions}"
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile_select(
+    table_name: str,
+    columns: t.Tuple[str, ...],
+    where_columns: t.Tuple[str, ...],
+) -> str:
+    select_query = f"SELECT {', '.join(columns)} FROM {table_name} "
+    if where_columns:
+        where_conditions = " AND ".join(f"{column} = ?" for column in where_columns)
+        select_query += f"WHERE {where_conditions}"
+
+    return select_query
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile_count(
+    table_name: str,
+    column: t.Optional[str],
+    distinct: bool,
+    where_columns: t.Tuple[str, ...],
+) -> str:
+    count_query = f"SELECT COUNT({'DISTINCT ' if distinct else ''}{column}) FROM {table_name} "
+    if where_columns:
+        where_conditions = " AND ".join(f"{column} = ?" for column in where_columns)
+        count_query += f"WHERE {where_conditions}"
+
+    return count_query
+
 
 class WhereClauseMixin:
     def __init__(self) -> None:
@@ -51,8 +131,8 @@ class WhereClauseMixin:
         self.where_clause.extend(conditions.items())
         return self
 
-    def _generate_where_conditions(self) -> str:
-        return " AND ".join(f"{column} = ?" for column, _ in self.where_clause)
+    def _where_columns(self) -> t.Tuple[str, ...]:
+        return tuple(column for column, _ in self.where_clause)
 
     def _where_values(self) -> t.List[t.Any]:
         return [value for _, value in self.where_clause]
@@ -67,8 +147,8 @@ class SetClauseMixin:
         self.set_clauses.extend(columns.items())
         return self
 
-    def _generate_set_conditions(self) -> str:
-        return ", ".join(f"{column} = ?" for column, _ in self.set_clauses)
+    def _set_columns(self) -> t.Tuple[str, ...]:
+        return tuple(column for column, _ in self.set_clauses)
 
     def _set_values(self) -> t.List[t.Any]:
         return [value for _, value in self.set_clauses]
@@ -80,6 +160,11 @@ class UpdateQuery(SetClauseMixin, WhereClauseMixin):
         self._db: Database = db
         self.set_clauses: t.List[t.Tuple[str, t.Any]] = []
 
+    def _compile(self) -> str:
+        return _compile_update(
+            self._db.table_name, self._set_columns(), self._where_columns()
+        )
+
     async def execute(self) -> int:
         if not self.set_clauses:
             raise ValueError("No columns provided to update.")
@@ -87,17 +172,14 @@ class UpdateQuery(SetClauseMixin, WhereClauseMixin):
         if not self.where_clause:
             raise ValueError("No conditions provided to update.")
 
-        set_conditions = self._generate_set_conditions()
-        where_conditions = self._generate_where_conditions()
-
-        update_query = f"UPDATE {self._db.table_name} SET {set_conditions} WHERE {where_conditions}"
+        update_query = self._compile()
 
         set_values = self._set_values()
         where_values = self._where_values()
 
         async with self._db._conn.cursor() as cr:
             await cr.execute(update_query, *[*set_values, *where_values])
-            await self._db._conn.commit()
+            await self._db._commit()
             rowcount = cr._cursor.rowcount
         return rowcount
 
@@ -107,18 +189,19 @@ class DeleteQuery(WhereClauseMixin):
         super().__init__()
         self._db: Database = db
 
+    def _compile(self) -> str:
+        return _compile_delete(self._db.table_name, self._where_columns())
+
     async def execute(self) -> int:
         if not self.where_clause:
             raise ValueError("No conditions provided for deletion.")
 
-        where_conditions = self._generate_where_conditions()
+        delete_query = self._compile()
         where_values = self._where_values()
 
-        delete_query = f"DELETE FROM {self._db.table_name} WHERE {where_conditions}"
-
         async with self._db._conn.cursor() as cr:
             await cr.execute(delete_query, *where_values)
-            await self._db._conn.commit()
+            await self._db._commit()
             rowcount = cr._cursor.rowcount
         return rowcount
 
@@ -133,16 +216,14 @@ class FetchQuery(WhereClauseMixin):
         self.columns_to_fetch.extend(columns)
         return self
 
-    async def execute(self) -> list[asqlite.sqlite3.Row]:
-        where_values: list[t.Any] = []
-
-        columns = ", ".join(self.columns_to_fetch)
-        select_query = f"SELECT {columns} FROM {self._db.table_name} "
+    def _compile(self) -> str:
+        return _compile_select(
+            self._db.table_name, tuple(self.columns_to_fetch), self._where_columns()
+        )
 
-        if self.where_clause:
-            where_conditions = self._generate_where_conditions()
-            where_values = self._where_values()
-            select_query += f"WHERE {where_conditions}"
+    async def execute(self) -> list[asqlite.sqlite3.Row]:
+        select_query = self._compile()
+        where_values = self._where_values()
 
         async with self._db._conn.cursor() as cr:
             await cr.execute(select_query, *where_values)
@@ -167,19 +248,22 @@ class CountQuery(WhereClauseMixin):
         self.distinct = distinct
         return self
 
+    def _compile(self) -> str:
+        return _compile_count(
+            self._db.table_name,
+            self.column_to_count,
+            self.distinct,
+            self._where_columns(),
+        )
+
     async def execute(self) -> int:
         if self.column_to_count == "*" and self.distinct:
             raise ValueError(
                 "Cannot count all columns while using DISTINCT at the same time."
             )
 
-        where_values: list[t.Any] = []
-        count_query = f"SELECT COUNT({'DISTINCT ' if self.distinct else ''}{self.column_to_count}) FROM {self._db.table_name} "
-
-        if self.where_clause:
-            where_conditions = self._generate_where_conditions()
-            where_values = self._where_values()
-            count_query += f"WHERE {where_conditions}"
+        count_query = self._compile()
+        where_values = self._where_values()
 
         async with self._db._conn.cursor() as cr:
             await cr.execute(count_query, *where_values)
@@ -188,40 +272,345 @@ class CountQuery(WhereClauseMixin):
         return count
 
 
+def _database_path(table_name: str) -> pathlib.Path:
+    return pathlib.Path("./data") / f"{table_name}.db"
+
+
+class ConnectionPool:
+    """A fixed amount of connections to a database file, opened once and reused.
+
+    Every connection of asqlite runs on its own thread, so opening one per
+    query would start a thread each time. Connections idle for longer than
+    `health_check_interval` are checked before being handed out, and replaced
+    if they stopped working.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        *,
+        size: int = DEFAULT_POOL_SIZE,
+        health_check_interval: float = HEALTH_CHECK_INTERVAL,
+    ) -> None:
+        if size < 1:
+            raise ValueError("A connection pool needs at least one connection")
+
+        self.path = path
+        self.size = size
+        self.health_check_interval = health_check_interval
+
+        self._connections: list[asqlite.Connection] = []
+        self._idle: asyncio.Queue[t.Tuple[asqlite.Connection, float]] = asyncio.Queue()
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def __repr__(self) -> str:
+        return (
+            f"<ConnectionPool path={self.path.as_posix()!r} size={self.size} "
+            f"idle={self._idle.qsize()}>"
+        )
+
+    async def _connect(self) -> asqlite.Connection:
+        return await asqlite.connect(
+            database=self.path.as_posix(),
+            detect_types=asqlite.PARSE_DECLTYPES,
+        )
+
+    async def open(self) -> None:
+        async with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot open a closed connection pool")
+
+            while len(self._connections) < self.size:
+                conn = await self._connect()
+                self._connections.append(conn)
+                self._idle.put_nowait((conn, time.monotonic()))
+
+    async def _is_healthy(self, conn: asqlite.Connection) -> bool:
+        try:
+            await asyncio.wait_for(conn.fetchone("SELECT 1"), HEALTH_CHECK_TIMEOUT)
+        except (sqlite3.Error, asyncio.TimeoutError):
+            return False
+
+        return True
+
+    @staticmethod
+    async def _close_connection(conn: asqlite.Connection) -> None:
+        with contextlib.suppress(sqlite3.Error, asyncio.TimeoutError):
+            await asyncio.wait_for(conn.close(), HEALTH_CHECK_TIMEOUT)
+
+    async def _replace(self, conn: asqlite.Connection) -> asqlite.Connection:
+        await self._close_connection(conn)
+        new_conn = await self._connect()
+        self._connections[self._connections.index(conn)] = new_conn
+        return new_conn
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> t.AsyncIterator[asqlite.Connection]:
+        if self._closed:
+            raise RuntimeError("The connection pool is closed")
+
+        conn, released_at = await self._idle.get()
+        # A connection that couldn't be replaced goes back as if it was never
+        # checked, so the next one to get it tries again
+        checked_at = 0.0
+        try:
+            if time.monotonic() - released_at < self.health_check_interval:
+                checked_at = released_at
+            elif await self._is_healthy(conn):
+                checked_at = time.monotonic()
+            else:
+                conn = await self._replace(conn)
+                checked_at = time.monotonic()
+
+            yield conn
+        finally:
+            # Whatever is left uncommitted isn't passed on to the next user
+            with contextlib.suppress(sqlite3.Error):
+                if conn.get_connection().in_transaction:
+                    await conn.rollback()
+
+            if self._closed:
+                await self._close_connection(conn)
+            else:
+                self._idle.put_nowait((conn, checked_at))
+
+    async def close(self) -> None:
+        """Closes the idle connections, the ones in use are closed once released."""
+        self._closed = True
+        while not self._idle.empty():
+            conn, _ = self._idle.get_nowait()
+            await self._close_connection(conn)
+
+
+_pools: dict[pathlib.Path, ConnectionPool] = {}
+
+
+async def open_pool(
+    table_name: str,
+    *,
+    size: int = DEFAULT_POOL_SIZE,
+    health_check_interval: float = HEALTH_CHECK_INTERVAL,
+) -> ConnectionPool:
+    """Opens the connection pool of a table's database, unless already opened.
+
+    Meant to be called once at startup, a `Database` whose pool wasn't opened
+    opens one with the default settings the first time it's entered.
+    """
+    path = _database_path(table_name)
+    pool = _pools.get(path)
+    if pool is None:
+        pool = _pools[path] = ConnectionPool(
+            path,
+            size=size,
+            health_check_interval=health_check_interval,
+        )
+
+    await pool.open()
+    return pool
+
+
+async def close_pools() -> None:
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.close()
+
+
+class Index(t.NamedTuple):
+    """An index of a table, declared next to its columns.
+
+    Indexes are created along with the table, or added to an existing one,
+    the first time the table is used.
+    """
+
+    columns: t.Tuple[str, ...]
+    unique: bool = False
+
+    def name(self, table_name: str) -> str:
+        prefix = "uq" if self.unique else "idx"
+        return f"{prefix}_{table_name}_{'_'.join(self.columns)}"
+
+    def definition(self, table_name: str) -> str:
+        unique = "UNIQUE " if self.unique else ""
+        return (
+            f"CREATE {unique}INDEX IF NOT EXISTS {self.name(table_name)} "
+            f"ON {table_name} ({', '.join(self.columns)})"
+        )
+
+
+class SchemaRegistry:
+    """The tables already created or validated by this process.
+
+    A table is bootstrapped the first time it's used, either by
+    `register_table` at startup or by entering a `Database`, and every use
+    afterwards skips straight to the queries.
+    """
+
+    def __init__(self) -> None:
+        self._tables: dict[
+            t.Tuple[pathlib.Path, str],
+            t.Tuple[dict[str, DataType], set[Index]],
+        ] = {}
+        self._lock = asyncio.Lock()
+        self.ddl_statements = 0
+
+    def __repr__(self) -> str:
+        return f"<SchemaRegistry tables={len(self._tables)} ddl_statements={self.ddl_statements}>"
+
+    def is_registered(
+        self,
+        path: pathlib.Path,
+        table_name: str,
+        columns: dict[str, DataType],
+        indexes: t.Collection[Index] = (),
+    ) -> bool:
+        registered = self._tables.get((path, table_name))
+        return (
+            registered is not None
+            and registered[0] == columns
+            and registered[1].issuperset(indexes)
+        )
+
+    async def ensure(
+        self,
+        conn: asqlite.Connection,
+        path: pathlib.Path,
+        table_name: str,
+        columns: dict[str, DataType],
+        indexes: t.Collection[Index] = (),
+    ) -> None:
+        """Creates the table, or checks that the existing one has these columns.
+
+        Indexes missing from the table are created either way.
+        """
+        async with self._lock:
+            registered = self._tables.get((path, table_name))
+            if registered is not None and registered[0] != columns:
+                raise ValueError(
+                    f"Table {table_name!r} was already registered with other columns"
+                )
+
+            async with conn.cursor() as cr:
+                if registered is None:
+                    await self._ensure_table(cr, table_name, columns)
+                    registered = self._tables[(path, table_name)] = (dict(columns), set())
+
+                missing = [index for index in indexes if index not in registered[1]]
+                existing: set[str] = set()
+                if missing:
+                    await cr.execute(f"PRAGMA index_list({table_name})")
+                    existing = {row[1] for row in await cr.fetchall()}
+
+                for index in missing:
+                    if index.name(table_name) not in existing:
+                        await cr.execute(index.definition(table_name))
+                        self.ddl_statements += 1
+
+                    registered[1].add(index)
+
+    async def _ensure_table(
+        self,
+        cr: asqlite.Cursor,
+        table_name: str,
+        columns: dict[str, DataType],
+    ) -> None:
+        await cr.execute(f"PRAGMA table_info({table_name})")
+        existing = {row[1]: row[2] for row in await cr.fetchall()}
+
+        if existing:
+            self._validate(table_name, columns, existing)
+            return
+
+        definitions = ", ".join(
+            f"{name} {data_type.value}" for name, data_type in columns.items()
+        )
+        await cr.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({definitions})")
+        self.ddl_statements += 1
+
+    @staticmethod
+    def _validate(
+        table_name: str,
+        columns: dict[str, DataType],
+        existing: dict[str, str],
+    ) -> None:
+        expected = {name: data_type.declared_type for name, data_type in columns.items()}
+        if existing == expected:
+            return
+
+        differences = [
+            f"{name} is {existing.get(name, 'missing')}, expected {expected.get(name, 'nothing')}"
+            for name in {**expected, **existing}
+            if existing.get(name) != expected.get(name)
+        ]
+        raise RuntimeError(
+            f"Table {table_name!r} doesn't match its schema: {'; '.join(differences)}"
+        )
+
+
+schema_registry = SchemaRegistry()
+
+
+async def register_table(
+    table_name: str,
+    *,
+    columns: dict[str, DataType],
+    indexes: t.Collection[Index] = (),
+) -> None:
+    """Creates or validates a table ahead of its first use, meant for startup."""
+    path = _database_path(table_name)
+    pool = _pools.get(path)
+    if pool is None:
+        pool = await open_pool(table_name)
+
+    async with pool.acquire() as conn:
+        await schema_registry.ensure(conn, path, table_name, columns, indexes)
+
+
 class Database:
     _table_name: str
     _db_path: pathlib.Path
     _conn: asqlite.Connection
     _columns: dict[str, DataType]
+    _indexes: t.Tuple[Index, ...]
+    _acquired: t.AsyncContextManager[asqlite.Connection]
+    _transaction_depth: int
 
-    def __init__(self, table_name: str, *, columns: dict[str, DataType]) -> None:
+    def __init__(
+        self,
+        table_name: str,
+        *,
+        columns: dict[str, DataType],
+        indexes: t.Iterable[Index] = (),
+    ) -> None:
         self._columns = columns
+        self._indexes = tuple(indexes)
 
         self._table_name = table_name
-        self._db_path = pathlib.Path("./data") / f"{table_name}.db"
-
-        self._db_path.touch()
+        self._db_path = _database_path(table_name)
+        self._transaction_depth = 0
 
-    async def _create_table(self, columns: dict[str, DataType]) -> None:
-        definitions = [
-            f"{name} {data_type.value}" for name, data_type in columns.items()
-        ]
+    async def __aenter__(self) -> t.Self:
+        pool = _pools.get(self._db_path)
+        if pool is None:
+            pool = await open_pool(self._table_name)
 
-        query = (
-            f"CREATE TABLE IF NOT EXISTS {self._table_name} ({', '.join(definitions)})"
-        )
+        self._acquired = pool.acquire()
+        self._conn = await self._acquired.__aenter__()
 
-        async with self._conn.cursor() as cr:
-            await cr.execute(query)
-            await self._conn.commit()
+        if schema_registry.is_registered(
+            self._db_path, self._table_name, self._columns, self._indexes
+        ):
+            return self
 
-    async def __aenter__(self) -> t.Self:
-        self._conn = await asqlite.connect(
-            database=self._db_path.as_posix(),
-            detect_types=asqlite.PARSE_DECLTYPES,
-        ).__aenter__()
+        try:
+            await schema_registry.ensure(
+                self._conn, self._db_path, self._table_name, self._columns, self._indexes
+            )
+        except BaseException as e:
+            await self._acquired.__aexit__(type(e), e, e.__traceback__)
+            raise
 
-        await self._create_table(self._columns)
         return self
 
     async def __aexit__(
@@ -230,11 +619,50 @@ class Database:
         exc_value: BaseException,
         traceback: TracebackType,
     ) -> None:
-        return await self._conn.__aexit__(
-            exc_type=exc_type,
-            exc_value=exc_value,
-            traceback=traceback,
-        )
+        await self._acquired.__aexit__(exc_type, exc_value, traceback)
+
+    async def _commit(self) -> None:
+        # Inside a transaction the commit is left to the end of it
+        if not self._transaction_depth:
+            await self._conn.commit()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, *, immediate: bool = False) -> t.AsyncIterator[None]:
+        """Groups every query of the block in a single transaction.
+
+        The queries don't commit on their own, everything is committed once
+        the block ends, or rolled back if it raises. Nested blocks become
+        savepoints, rolling back only their own queries.
+
+        Parameters:
+        -----------
+            immediate (`bool`): Whether to take the write lock right away, for
+                blocks reading something and then writing based on it.
+        """
+        depth = self._transaction_depth
+        savepoint = f"transaction_{depth}"
+        if depth:
+            await self._conn.execute(f"SAVEPOINT {savepoint}")
+        else:
+            await self._conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            if depth:
+                await self._conn.execute(f"ROLLBACK TO {savepoint}")
+                await self._conn.execute(f"RELEASE {savepoint}")
+            else:
+                await self._conn.rollback()
+            raise
+        else:
+            if depth:
+                await self._conn.execute(f"RELEASE {savepoint}")
+            else:
+                await self._conn.commit()
+        finally:
+            self._transaction_depth = depth
 
     @property
     def table_name(self) -> str:
@@ -247,34 +675,92 @@ class Database:
     def _is_sqlite_serializable(self, obj: t.Any) -> t.TypeGuard[SQLSerializable]:
         return isinstance(obj, SQLSerializable)  # type: ignore # SQLSerializable is a tuple at runtime
 
+    def _check_serializable(self, values: t.Iterable[t.Any]) -> None:
+        if not all(self._is_sqlite_serializable(obj) for obj in values):
+            raise ValueError("You provided a non-serializable object to be stored")
+
     async def insert(self, **kwds: t.Any) -> dict[str, t.Any]:
         if not kwds:
             raise ValueError("No values provided for insertion")
 
-        # fmt: off
-        has_unserializable = any([
-            not self._is_sqlite_serializable(obj) 
-            for obj in kwds.values()
-        ])
-        # fmt: on
-
-        if has_unserializable:
-            raise ValueError("You provided a non-serializable object to be stored")
-
-        keys = tuple(kwds.keys())
         values = tuple(kwds.values())
+        self._check_serializable(values)
 
-        placeholders = ", ".join("?" for _ in keys)
-        columns = ", ".join(keys)
-
-        query = f"INSERT INTO {self._table_name} ({columns}) VALUES ({placeholders})"
+        query = _compile_insert(self._table_name, tuple(kwds))
 
         async with self._conn.cursor() as cr:
             await cr.execute(query, values)
-            await self._conn.commit()
+            await self._commit()
 
         return kwds
 
+    async def insert_many(
+        self,
+        rows: t.Union[
+            t.Iterable[t.Mapping[str, t.Any]],
+            t.AsyncIterable[t.Mapping[str, t.Any]],
+        ],
+    ) -> int:
+        """Inserts many rows in a single transaction, returning how many were inserted.
+
+        Every row must have the same columns as the first one, which are only
+        validated once. Rows are consumed as they're inserted, so neither kind
+        of iterable is ever turned into a list.
+        """
+        if isinstance(rows, t.AsyncIterable):
+            async_rows = aiter(rows)
+            first = await anext(async_rows, None)
+        else:
+            sync_rows = iter(rows)
+            first = next(sync_rows, None)
+
+        if first is None:
+            return 0
+
+        columns = tuple(first)
+        if not columns:
+            raise ValueError("No values provided for insertion")
+
+        unknown = set(columns).difference(self._columns)
+        if unknown:
+            raise ValueError(
+                f"Unknown columns for {self._table_name}: {', '.join(sorted(unknown))}"
+            )
+
+        query = _compile_insert(self._table_name, columns)
+        first_keys = first.keys()
+
+        def to_values(row: t.Mapping[str, t.Any]) -> t.Tuple[t.Any, ...]:
+            if row.keys() != first_keys:
+                raise ValueError("Every row must have the same columns")
+
+            values = tuple(row[column] for column in columns)
+            self._check_serializable(values)
+            return values
+
+        async with self.transaction(), self._conn.cursor() as cr:
+            if not isinstance(rows, t.AsyncIterable):
+                # The rows are pulled by sqlite itself, on the connection's thread
+                await cr.executemany(
+                    query, map(to_values, itertools.chain((first,), sync_rows))
+                )
+                return cr._cursor.rowcount
+
+            inserted = 0
+            batch = [to_values(first)]
+            async for row in async_rows:
+                batch.append(to_values(row))
+                if len(batch) >= INSERT_MANY_BATCH:
+                    await cr.executemany(query, batch)
+                    inserted += cr._cursor.rowcount
+                    batch.clear()
+
+            if batch:
+                await cr.executemany(query, batch)
+                inserted += cr._cursor.rowcount
+
+        return inserted
+
     def update(self, **columns: t.Any) -> UpdateQuery:
         if not columns:
             raise ValueError("No columns provided to update.")
@@ -0,0 +1,160 @@
+"""Near-duplicate detection for the messages learned by the Markov model.
+
+Messages are reduced to MinHash signatures over their word shingles, and the
+bands of every signature seen recently are remembered by a rotating Bloom
+filter. A message sharing a band with a recent one is a near-duplicate, so
+copypasta and spam are learned once per window instead of once per paste.
+Memory is fixed by the window size whatever the traffic is.
+"""
+from __future__ import annotations
+import typing as t
+
+import random
+import math
+
+__all__ = (
+    "NearDuplicateFilter",
+    "RotatingBloomFilter",
+)
+
+_MERSENNE_PRIME: t.Final[int] = (1 << 61) - 1
+_HASH_MASK: t.Final[int] = (1 << 64) - 1
+
+
+class RotatingBloomFilter:
+    """A Bloom filter forgetting what is older than about `capacity` keys.
+
+    Keys go into the current generation, and once it holds `capacity` of them
+    it replaces the previous one, which is dropped. Lookups check both, so a
+    key is remembered for between `capacity` and twice as many insertions.
+
+    Parameters:
+    -----------
+        capacity (`int`): The amount of keys of a generation.
+        error_rate (`float`): The false positive rate of a full generation.
+    """
+
+    __slots__ = ("capacity", "n_bits", "n_hashes", "_current", "_previous", "_count")
+
+    def __init__(self, capacity: int, *, error_rate: float = 0.001) -> None:
+        self.capacity = capacity
+        self.n_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+
+        self._current = bytearray((self.n_bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._current) + len(self._previous)
+
+    def _positions(self, key: int) -> t.Iterator[int]:
+        # Double hashing, both halves of a 64-bit hash give every position
+        key &= _HASH_MASK
+        low, high = key & 0xFFFFFFFF, key >> 32
+        for i in range(self.n_hashes):
+            yield (low + i * high) % self.n_bits
+
+    @staticmethod
+    def _test(bits: bytearray, positions: t.Sequence[int]) -> bool:
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+
+    def __contains__(self, key: int) -> bool:
+        positions = list(self._positions(key))
+        return self._test(self._current, positions) or self._test(self._previous, positions)
+
+    def add(self, key: int) -> None:
+        if self._count >= self.capacity:
+            self._previous, self._current = self._current, bytearray(len(self._current))
+            self._count = 0
+
+        for pos in self._positions(key):
+            self._current[pos >> 3] |= 1 << (pos & 7)
+
+        self._count += 1
+
+
+class NearDuplicateFilter:
+    """Tells whether a message is a near-duplicate of one seen recently.
+
+    Parameters:
+    -----------
+        window (`int`): About how many recent messages are remembered.
+        num_perm (`int`): The amount of MinHash permutations of a signature.
+        bands (`int`): In how many bands a signature is split, sharing any of
+            them makes two messages near-duplicates. More bands catch messages
+            that are less alike.
+        shingle_size (`int`): The amount of words of each shingle.
+        min_tokens (`int`): Messages shorter than this are never dropped, short
+            replies like "kkkk" or "bom dia" repeat all the time in a chat and
+            how often they do is what the chain should learn.
+        seed (`int`): Seed of the MinHash permutations.
+    """
+
+    def __init__(
+        self,
+        *,
+        window: int = 5_000,
+        num_perm: int = 16,
+        bands: int = 4,
+        shingle_size: int = 2,
+        min_tokens: int = 4,
+        seed: int = 0,
+    ) -> None:
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+
+        if min_tokens < shingle_size:
+            raise ValueError("min_tokens can't be smaller than shingle_size")
+
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_tokens = min_tokens
+
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(_MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self._seen = RotatingBloomFilter(window * bands)
+
+        self.checked = 0
+        self.dropped = 0
+
+    def __repr__(self) -> str:
+        return f"<NearDuplicateFilter checked={self.checked} dropped={self.dropped}>"
+
+    def _keys(self, tokens: t.Sequence[str]) -> list[int]:
+        size = self.shingle_size
+        shingles = {
+            hash(tuple(tokens[i : i + size])) & _HASH_MASK
+            for i in range(len(tokens) - size + 1)
+        }
+        signature = [
+            min((a * shingle + b) % _MERSENNE_PRIME for shingle in shingles)
+            for a, b in self._permutations
+        ]
+
+        rows = self.rows
+        return [
+            hash((band, *signature[band * rows : (band + 1) * rows]))
+            for band in range(self.bands)
+        ]
+
+    def is_duplicate(self, tokens: t.Sequence[str]) -> bool:
+        """Checks a message, remembering it if it isn't a near-duplicate."""
+        self.checked += 1
+        if len(tokens) < self.min_tokens:
+            return False
+
+        keys = self._keys(tokens)
+        if any(key in self._seen for key in keys):
+            self.dropped += 1
+            return True
+
+        for key in keys:
+            self._seen.add(key)
+
+        return False
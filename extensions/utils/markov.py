@@ -3,17 +3,313 @@ import typing as t
 
 from types import TracebackType
 
-from collections import defaultdict
+from collections import Counter, OrderedDict, deque
+from concurrent import futures
+import contextlib
+import functools
+import asyncio
+import math
+import multiprocessing
 import random
-import string
 
 import asqlite
 import datetime
+import pathlib
+import sqlite3
 
-__all__ = ("MarkovModel",)
+from .tokenizer import TOKENIZER_VERSION, normalize_many, tokenize, tokenize_many
+from .chain import Chain, ChainBuilder, Snapshot, State, Transitions, iter_transitions
+from .dedup import NearDuplicateFilter
 
+__all__ = (
+    "ChainCache",
+    "GenerationSkipped",
+    "MarkovModel",
+    "MarkovShards",
+    "SentencePool",
+)
 
-Chain: t.TypeAlias = defaultdict[str, list[str]]
+_T = t.TypeVar("_T")
+
+
+ExecutorMode: t.TypeAlias = t.Literal["inline", "thread", "process"]
+
+
+class GenerationSkipped(Exception):
+    """Exception raised when a text couldn't be generated in time
+
+    Either every generation slot was busy or the generation timed out.
+    """
+
+    pass
+
+
+TransitionCounts: t.TypeAlias = Counter[t.Tuple[State, str]]
+
+
+class _Candidate:
+    """A text being generated, one of the candidates of a reply."""
+
+    __slots__ = ("words", "dead_ends", "finished")
+
+    def __init__(self, start: State) -> None:
+        self.words = list(start)
+        self.dead_ends = 0
+        self.finished = False
+
+
+# How much a jump to a random state, after reaching a dead end, costs to a candidate
+_DEAD_END_PENALTY: t.Final[float] = 0.5
+
+
+def _group_candidates(
+    candidates: t.Iterable[_Candidate],
+    n_words: int,
+    state_size: int,
+) -> dict[State, list[_Candidate]]:
+    """The unfinished candidates grouped by their current state."""
+    groups: dict[State, list[_Candidate]] = {}
+    for candidate in candidates:
+        if candidate.finished or len(candidate.words) >= n_words:
+            continue
+
+        state = tuple(candidate.words[-state_size:])
+        groups.setdefault(state, []).append(candidate)
+
+    return groups
+
+
+def _best_candidate(
+    candidates: t.Sequence[_Candidate],
+    n_words: int,
+    seed: t.Sequence[str],
+) -> str:
+    """The text of the best candidate.
+
+    Candidates score by how close they got to `n_words` words, by how many of
+    the seed words they share and lose points for every dead end they hit.
+    """
+    seed_words = set(seed)
+
+    def score(candidate: _Candidate) -> float:
+        words = candidate.words[:n_words]
+        value = len(words) / n_words
+        if seed_words:
+            value += len(seed_words.intersection(words)) / len(seed_words)
+
+        return value - _DEAD_END_PENALTY * candidate.dead_ends
+
+    best = max(candidates, key=score)
+    return " ".join(best.words[:n_words])
+
+
+async def _generate_candidates(
+    fetch_followers: t.Callable[[State], t.Awaitable[Transitions]],
+    random_state: t.Callable[[], t.Awaitable[t.Optional[State]]],
+    seed_state: t.Callable[[t.Sequence[str]], t.Awaitable[t.Optional[State]]],
+    *,
+    n_words: int,
+    state_size: int,
+    seed: t.Sequence[str] = (),
+    candidates: int = 1,
+) -> str:
+    """Walks `candidates` texts through the transitions and returns the best one.
+
+    The lookups are given as coroutine functions, so the same walk runs on the
+    model's connection and, through `_run_sync`, inside of the generation executor.
+
+    Raises:
+    -------
+        `ValueError`: If there is no state to start from.
+    """
+    walks: list[_Candidate] = []
+    for _ in range(candidates):
+        first_state = await seed_state(seed) if seed else None
+        if first_state is None:
+            first_state = await random_state()
+
+        if first_state is None:
+            raise ValueError("The database does not contains any entries")
+
+        walks.append(_Candidate(first_state))
+
+    # Every candidate moves a word per round, those sharing a state share
+    # its lookup and draw their next words together.
+    while groups := _group_candidates(walks, n_words, state_size):
+        for state, group in groups.items():
+            followers = await fetch_followers(state)
+            if followers:
+                for walk, word in zip(group, followers.choices(len(group))):
+                    walk.words.append(word)
+                continue
+
+            # Transitions are stored per message, so the last state of
+            # a message leads nowhere. Jump to another state instead.
+            for walk in group:
+                walk.dead_ends += 1
+                next_state = await random_state()
+                if next_state is None:
+                    walk.finished = True
+                else:
+                    walk.words.extend(next_state)
+
+    return _best_candidate(walks, n_words, seed)
+
+
+def _run_sync(coro: t.Coroutine[t.Any, t.Any, _T]) -> _T:
+    """Runs a coroutine that never suspends, without an event loop."""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+    coro.close()
+    raise RuntimeError("the coroutine suspended, it needs an event loop")
+
+
+def _count_transitions(
+    messages: t.Iterable[str],
+    state_size: int = 1,
+) -> TransitionCounts:
+    """Counts every (state, next word) pair found inside of the given messages."""
+    counts: TransitionCounts = Counter()
+    for msg in messages:
+        counts.update(iter_transitions(msg.split(), state_size))
+
+    return counts
+
+
+def _local_timestamp(timestamp: datetime.datetime) -> str:
+    """A timestamp in the format and timezone of `DATETIME('now', 'localtime')`."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# States are stored in the database as their words joined by a space, words
+# never contain whitespace, so this is reversible.
+def _state_key(state: State) -> str:
+    return " ".join(state)
+
+
+def _key_state(key: str) -> State:
+    return tuple(key.split(" "))
+
+
+def _state_words(states: t.Iterable[State]) -> list[t.Tuple[str, str]]:
+    """The (word, state key) rows of the inverted index for the given states."""
+    return [(word, _state_key(state)) for state in states for word in set(state)]
+
+
+_SELECT_FOLLOWERS = "SELECT next_word, count FROM transitions WHERE state = ?"
+_SELECT_MAX_ROWID = "SELECT MAX(rowid) FROM transitions"
+# Seeking a random rowid keeps this an index lookup, instead of
+# scanning the table with `ORDER BY RANDOM()`.
+_SELECT_STATE_AT = (
+    "SELECT state FROM transitions WHERE rowid >= ? ORDER BY rowid LIMIT 1"
+)
+_MESSAGES_BATCH_SIZE: t.Final[int] = 1_000
+_MAX_ROWID: t.Final[int] = 2**63 - 1
+_INCREMENTAL_VACUUM: t.Final[int] = 2
+
+# Like `_SELECT_STATE_AT`, every row of the inverted index has a random key so
+# a random state of a word is an index seek. Past the last key of the word it
+# wraps around to its first one.
+_SELECT_WORD_STATE_AT = (
+    "SELECT state FROM state_words WHERE word = ? AND key >= ? ORDER BY key LIMIT 1"
+)
+_SELECT_FIRST_WORD_STATE = (
+    "SELECT state FROM state_words WHERE word = ? ORDER BY key LIMIT 1"
+)
+
+# Counts every deletion, a snapshot saved before one is no longer valid
+_BUMP_DELETIONS = """
+INSERT INTO metadata (key, value) VALUES ('deletions', 1)
+ON CONFLICT (key) DO UPDATE SET value = value + 1
+"""
+
+# Rough size of the stored rows, for when SQLite has no dbstat table. The
+# timestamp, the UNIQUE index of the transitions and the key index of the
+# inverted index are counted too.
+_ESTIMATE_USED_BYTES = """
+SELECT
+    (SELECT COALESCE(SUM(LENGTH(CAST(message AS BLOB)) + 2 * 19), 0) FROM messages)
+    + (
+        SELECT COALESCE(SUM(
+            2 * (LENGTH(CAST(state AS BLOB)) + LENGTH(CAST(next_word AS BLOB))) + 8
+        ), 0) FROM transitions
+    )
+    + (
+        SELECT COALESCE(SUM(
+            2 * (LENGTH(CAST(word AS BLOB)) + LENGTH(CAST(state AS BLOB)) + 8)
+        ), 0) FROM state_words
+    )
+"""
+
+
+def _seed_candidates(seed: t.Iterable[str]) -> list[str]:
+    words = list(dict.fromkeys(seed))
+    random.shuffle(words)
+    return words
+
+
+def _generate_from_file(
+    path: str,
+    state_size: int,
+    chain: Chain,
+    n_words: int,
+    seed: t.Sequence[str] = (),
+    candidates: int = 1,
+) -> str:
+    """Synchronous version of `MarkovModel._generate_text`.
+
+    This is what runs inside of the generation executor, it walks the same
+    `_generate_candidates` but reads the transitions with its own read-only
+    connection so it can live in another thread or process.
+    """
+    conn = sqlite3.connect(f"{pathlib.Path(path).resolve().as_uri()}?mode=ro", uri=True)
+
+    async def fetch_followers(state: State) -> Transitions:
+        rows = conn.execute(_SELECT_FOLLOWERS, (_state_key(state),)).fetchall()
+        followers = Transitions(dict(rows))
+        extra = chain.get(state)
+        return followers.merged(extra) if extra is not None else followers
+
+    async def random_state() -> t.Optional[State]:
+        (max_rowid,) = conn.execute(_SELECT_MAX_ROWID).fetchone()
+        if max_rowid is None:
+            return None
+
+        row = conn.execute(_SELECT_STATE_AT, (random.randint(1, max_rowid),)).fetchone()
+        return _key_state(row[0]) if row is not None else None
+
+    async def seed_state(words: t.Sequence[str]) -> t.Optional[State]:
+        for word in _seed_candidates(words):
+            key = random.randint(0, _MAX_ROWID)
+            row = conn.execute(_SELECT_WORD_STATE_AT, (word, key)).fetchone()
+            if row is None:
+                row = conn.execute(_SELECT_FIRST_WORD_STATE, (word,)).fetchone()
+
+            if row is not None:
+                return _key_state(row[0])
+
+        return None
+
+    try:
+        return _run_sync(
+            _generate_candidates(
+                fetch_followers,
+                random_state,
+                seed_state,
+                n_words=n_words,
+                state_size=state_size,
+                seed=seed,
+                candidates=candidates,
+            )
+        )
+    finally:
+        conn.close()
 
 
 if t.TYPE_CHECKING:
@@ -32,6 +328,9 @@ if t.TYPE_CHECKING:
 
 
 class DBProtocol(t.Protocol):
+    path: pathlib.Path
+    state_size: int
+
     async def __aenter__(self) -> t.Self:
         ...
 
@@ -46,39 +345,109 @@ class DBProtocol(t.Protocol):
     async def add_message(self, msg: str) -> None:
         ...
 
+    async def add_messages(
+        self,
+        msgs: t.Sequence[str],
+        *,
+        normalized: bool = False,
+        timestamps: t.Optional[t.Sequence[datetime.datetime]] = None,
+        metadata: t.Optional[t.Mapping[str, t.Any]] = None,
+    ) -> list[str]:
+        ...
+
     async def fetch_messages(self) -> t.Optional[list[MarkovDBRow]]:
         ...
 
+    def iter_messages(
+        self,
+        batch_size: int = _MESSAGES_BATCH_SIZE,
+        *,
+        after: int = 0,
+        until: t.Optional[int] = None,
+    ) -> t.AsyncIterator[list[MarkovDBRow]]:
+        ...
+
+    async def last_rowid(self) -> int:
+        ...
+
+    async def count_messages(self, *, until: t.Optional[int] = None) -> int:
+        ...
+
+    async def oldest_message(self) -> t.Optional[datetime.datetime]:
+        ...
+
+    async def deletions(self) -> int:
+        ...
+
+    async def fetch_transitions(self, state: State) -> dict[str, int]:
+        ...
+
+    async def random_state(self) -> t.Optional[State]:
+        ...
+
+    async def seed_state(self, words: t.Sequence[str]) -> t.Optional[State]:
+        ...
+
     async def trim_messages(
         self,
         *,
         before: t.Union[datetime.datetime, datetime.timedelta],
-    ) -> None:
+        limit: t.Optional[int] = None,
+    ) -> t.Tuple[int, set[State]]:
+        ...
+
+    async def over_budget(self) -> int:
+        ...
+
+    async def get_metadata(self, key: str) -> t.Any:
+        ...
+
+    async def set_metadata(self, key: str, value: t.Any) -> None:
+        ...
+
+    async def evict_messages(self, count: int) -> t.Tuple[int, set[State]]:
+        ...
+
+    async def compact(self, *, min_free: float = ...) -> int:
         ...
 
 
 class MarkovDB(DBProtocol):
-    def __init__(self) -> None:
+    """The messages learned by a Markov model and their transitions.
+
+    Parameters:
+    -----------
+        path (`Union[str, pathlib.Path]`): The database file.
+        state_size (`int`): The amount of words in each state.
+        max_messages (`Optional[int]`): The maximum amount of stored messages.
+        max_bytes (`Optional[int]`): The maximum size of the database file.
+    """
+
+    def __init__(
+        self,
+        path: t.Union[str, pathlib.Path] = "./data/markov.db",
+        *,
+        state_size: int = 1,
+        max_messages: t.Optional[int] = None,
+        max_bytes: t.Optional[int] = None,
+    ) -> None:
+        if state_size < 1:
+            raise ValueError("state_size must be greater than zero")
+
+        self.path = pathlib.Path(path)
+        self.state_size = state_size
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
         self._first_enter = True
 
     async def __aenter__(self) -> t.Self:
-        self.conn = conn = await asqlite.connect(
-            database="./data/markov.db",
+        self.conn = await asqlite.connect(
+            database=self.path.as_posix(),
             detect_types=asqlite.PARSE_DECLTYPES,
         ).__aenter__()
 
         if self._first_enter:
-            async with conn.cursor() as cr:
-                query = """
-                CREATE TABLE IF NOT EXISTS messages (
-                    message TEXT,
-                    timestamp TIMESTAMP DEFAULT (
-                        DATETIME('now', 'localtime')
-                    )
-                )
-                """
-                await cr.execute(query)
-                await conn.commit()
+            await self._create_tables()
 
         self._first_enter = False
         return self
@@ -91,12 +460,253 @@ class MarkovDB(DBProtocol):
     ) -> None:
         await self.conn.__aexit__(exc_type, exc_value, traceback)
 
-    async def add_message(self, msg: str) -> None:
-        msg = msg.lower()
+    async def _create_tables(self) -> None:
         async with self.conn.cursor() as cr:
-            await cr.execute("INSERT INTO messages (message) VALUES (?)", (msg,))
+            # Evicted messages are given back to the filesystem by `compact`,
+            # databases created before it only switch after a full vacuum.
+            await cr.execute("PRAGMA auto_vacuum")
+            (auto_vacuum,) = await cr.fetchone()
+            if auto_vacuum != _INCREMENTAL_VACUUM:
+                await cr.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await cr.execute("VACUUM")
+
+            query = """
+            CREATE TABLE IF NOT EXISTS messages (
+                message TEXT,
+                timestamp TIMESTAMP DEFAULT (
+                    DATETIME('now', 'localtime')
+                )
+            )
+            """
+            await cr.execute(query)
+            await cr.execute(
+                "CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages (timestamp)"
+            )
+
+            # Every (state, next word) pair seen in the stored messages and how
+            # many times it was seen, kept in sync by `add_message` and
+            # `trim_messages` so generation never has to rebuild the chain.
+            query = """
+            CREATE TABLE IF NOT EXISTS transitions (
+                state TEXT NOT NULL,
+                next_word TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                UNIQUE (state, next_word)
+            )
+            """
+            await cr.execute(query)
+
+            # Older databases have no random keys in the inverted index, it is
+            # dropped here and built again along with the transitions.
+            await cr.execute("PRAGMA table_info(state_words)")
+            columns = {column[1] for column in await cr.fetchall()}
+            if columns and "key" not in columns:
+                await cr.execute("DROP TABLE state_words")
+
+            # Inverted index of the words inside of each state, used to start
+            # generating from the words of the message being replied to.
+            query = """
+            CREATE TABLE IF NOT EXISTS state_words (
+                word TEXT NOT NULL,
+                state TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                PRIMARY KEY (word, state)
+            ) WITHOUT ROWID
+            """
+            await cr.execute(query)
+            await cr.execute(
+                "CREATE INDEX IF NOT EXISTS state_words_key ON state_words (word, key)"
+            )
+
+            query = """
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value
+            )
+            """
+            await cr.execute(query)
             await self.conn.commit()
 
+            await cr.execute("SELECT EXISTS (SELECT 1 FROM transitions)")
+            (populated,) = await cr.fetchone()
+
+            await cr.execute("SELECT EXISTS (SELECT 1 FROM state_words)")
+            (indexed,) = await cr.fetchone()
+
+            await cr.execute("SELECT value FROM metadata WHERE key = 'state_size'")
+            row = await cr.fetchone()
+
+            await cr.execute("SELECT value FROM metadata WHERE key = 'tokenizer'")
+            tokenizer = await cr.fetchone()
+
+        outdated = tokenizer is None or tokenizer[0] != TOKENIZER_VERSION
+        if outdated:
+            await self._normalize_messages()
+
+        # The transitions were counted with another state size, they are useless
+        if (
+            outdated
+            or not (populated and indexed)
+            or row is None
+            or row[0] != self.state_size
+        ):
+            await self.rebuild_transitions()
+
+    async def _normalize_messages(self) -> None:
+        """Normalises again the stored messages, they were stored by another tokenizer."""
+        async with self.conn.cursor() as cr:
+            await cr.execute("SELECT rowid, message FROM messages")
+            rows = await cr.fetchall()
+
+        normalized = normalize_many(row[1] or "" for row in rows)
+        async with self.conn.cursor(transaction=True) as cr:
+            await cr.executemany(
+                "UPDATE messages SET message = ? WHERE rowid = ?",
+                [
+                    (msg, row[0])
+                    for row, msg in zip(rows, normalized)
+                    if msg and msg != row[1]
+                ],
+            )
+            await cr.executemany(
+                "DELETE FROM messages WHERE rowid = ?",
+                [(row[0],) for row, msg in zip(rows, normalized) if not msg],
+            )
+            await cr.execute(_BUMP_DELETIONS)
+            await cr.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('tokenizer', ?)",
+                (TOKENIZER_VERSION,),
+            )
+
+    async def _apply_transitions(
+        self,
+        cr: asqlite.Cursor,
+        counts: TransitionCounts,
+        *,
+        sign: t.Literal[1, -1] = 1,
+    ) -> None:
+        if sign > 0:
+            await cr.executemany(
+                """
+                INSERT INTO transitions (state, next_word, count) VALUES (?, ?, ?)
+                ON CONFLICT (state, next_word) DO UPDATE SET count = count + excluded.count
+                """,
+                [
+                    (_state_key(state), word, count)
+                    for (state, word), count in counts.items()
+                ],
+            )
+            await cr.executemany(
+                "INSERT OR IGNORE INTO state_words (word, state, key) VALUES (?, ?, ?)",
+                [
+                    (word, state, random.randint(0, _MAX_ROWID))
+                    for word, state in _state_words({state for state, _ in counts})
+                ],
+            )
+            return
+
+        params = [
+            (count, _state_key(state), word) for (state, word), count in counts.items()
+        ]
+        await cr.executemany(
+            "UPDATE transitions SET count = count - ? WHERE state = ? AND next_word = ?",
+            params,
+        )
+        await cr.executemany(
+            "DELETE FROM transitions WHERE state = ? AND next_word = ? AND count <= 0",
+            [(state, word) for _, state, word in params],
+        )
+        await cr.executemany(
+            """
+            DELETE FROM state_words WHERE word = ? AND state = ?
+            AND NOT EXISTS (SELECT 1 FROM transitions WHERE state = ?)
+            """,
+            [
+                (word, state, state)
+                for word, state in _state_words({state for state, _ in counts})
+            ],
+        )
+
+    async def rebuild_transitions(self) -> None:
+        """Recomputes the whole transitions table from the stored messages.
+
+        Messages are counted a batch at a time, the upserts add the counts of
+        every batch together.
+        """
+        async with self.conn.cursor(transaction=True) as cr:
+            await cr.execute("DELETE FROM transitions")
+            await cr.execute("DELETE FROM state_words")
+            async for rows in self.iter_messages():
+                counts = _count_transitions((row[0] for row in rows), self.state_size)
+                await self._apply_transitions(cr, counts)
+            await cr.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('state_size', ?)",
+                (self.state_size,),
+            )
+
+    async def add_message(self, msg: str) -> None:
+        await self.add_messages((msg,))
+
+    async def add_messages(
+        self,
+        msgs: t.Sequence[str],
+        *,
+        normalized: bool = False,
+        timestamps: t.Optional[t.Sequence[datetime.datetime]] = None,
+        metadata: t.Optional[t.Mapping[str, t.Any]] = None,
+    ) -> list[str]:
+        """Stores all the given messages in a single transaction.
+
+        Messages are stored normalised by the tokenizer, unless `normalized`
+        tells they already are, and those without a single token are skipped.
+
+        Parameters:
+        -----------
+            timestamps (`Optional[Sequence[datetime.datetime]]`): When each
+                message was sent, for messages learned after the fact. Aware
+                datetimes are converted to local time, like the default one.
+                Messages are stored as sent now if not given.
+            metadata (`Optional[Mapping[str, Any]]`): Metadata stored in the
+                same transaction, as by `set_metadata`, so it can record what
+                was stored.
+
+        Returns:
+        --------
+            `list[str]`: The messages as they were stored.
+        """
+        if not normalized:
+            msgs = normalize_many(msgs)
+
+        if timestamps is None:
+            msgs = [msg for msg in msgs if msg]
+            rows: list[t.Tuple[t.Any, ...]] = [(msg,) for msg in msgs]
+            query = "INSERT INTO messages (message) VALUES (?)"
+        else:
+            if len(timestamps) != len(msgs):
+                raise ValueError("Every message needs a timestamp")
+
+            rows = [
+                (msg, _local_timestamp(timestamp))
+                for msg, timestamp in zip(msgs, timestamps)
+                if msg
+            ]
+            msgs = [msg for msg, _ in rows]
+            query = "INSERT INTO messages (message, timestamp) VALUES (?, ?)"
+
+        if not msgs and not metadata:
+            return msgs
+
+        async with self.conn.cursor(transaction=True) as cr:
+            if msgs:
+                await cr.executemany(query, rows)
+                counts = _count_transitions(msgs, self.state_size)
+                await self._apply_transitions(cr, counts)
+
+            for key, value in (metadata or {}).items():
+                await self._set_metadata(cr, key, value)
+
+        return msgs
+
     async def fetch_messages(self) -> t.Optional[list[MarkovDBRow]]:
         async with self.conn.cursor() as cr:
             await cr.execute("SELECT * FROM messages")
@@ -107,11 +717,119 @@ class MarkovDB(DBProtocol):
 
             return messages  # type: ignore
 
+    async def iter_messages(
+        self,
+        batch_size: int = _MESSAGES_BATCH_SIZE,
+        *,
+        after: int = 0,
+        until: t.Optional[int] = None,
+    ) -> t.AsyncIterator[list[MarkovDBRow]]:
+        """Yields the stored messages in batches of at most `batch_size` rows.
+
+        Only the messages whose rowid is greater than `after` and, if given, not
+        greater than `until` are yielded.
+        """
+        query = "SELECT * FROM messages WHERE rowid > ? AND rowid <= ?"
+        async with self.conn.cursor() as cr:
+            await cr.execute(query, (after, _MAX_ROWID if until is None else until))
+            while rows := await cr.fetchmany(batch_size):
+                yield rows  # type: ignore
+
+    async def last_rowid(self) -> int:
+        """The rowid of the last stored message, or zero without messages."""
+        async with self.conn.cursor() as cr:
+            await cr.execute("SELECT MAX(rowid) FROM messages")
+            (rowid,) = await cr.fetchone()
+
+        return rowid or 0
+
+    async def count_messages(self, *, until: t.Optional[int] = None) -> int:
+        async with self.conn.cursor() as cr:
+            await cr.execute(
+                "SELECT COUNT(*) FROM messages WHERE rowid <= ?",
+                (_MAX_ROWID if until is None else until,),
+            )
+            (count,) = await cr.fetchone()
+
+        return count
+
+    async def oldest_message(self) -> t.Optional[datetime.datetime]:
+        """When the oldest stored message was sent, as an aware datetime."""
+        async with self.conn.cursor() as cr:
+            # MIN() would lose the declared type, so the index is walked instead
+            await cr.execute("SELECT timestamp FROM messages ORDER BY timestamp LIMIT 1")
+            row = await cr.fetchone()
+
+        # Timestamps are stored in local time
+        return row[0].astimezone() if row is not None else None
+
+    async def deletions(self) -> int:
+        """How many times stored messages were deleted or rewritten."""
+        return await self.get_metadata("deletions") or 0
+
+    async def get_metadata(self, key: str) -> t.Any:
+        async with self.conn.cursor() as cr:
+            await cr.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+            row = await cr.fetchone()
+
+        return row[0] if row is not None else None
+
+    async def set_metadata(self, key: str, value: t.Any) -> None:
+        """Stores a value in the metadata table, or deletes it if `value` is None."""
+        async with self.conn.cursor() as cr:
+            await self._set_metadata(cr, key, value)
+
+    @staticmethod
+    async def _set_metadata(cr: asqlite.Cursor, key: str, value: t.Any) -> None:
+        if value is None:
+            await cr.execute("DELETE FROM metadata WHERE key = ?", (key,))
+        else:
+            await cr.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+
+    async def fetch_transitions(self, state: State) -> dict[str, int]:
+        async with self.conn.cursor() as cr:
+            await cr.execute(_SELECT_FOLLOWERS, (_state_key(state),))
+            rows = await cr.fetchall()
+
+        return {word: count for word, count in rows}
+
+    async def random_state(self) -> t.Optional[State]:
+        async with self.conn.cursor() as cr:
+            await cr.execute(_SELECT_MAX_ROWID)
+            (max_rowid,) = await cr.fetchone()
+            if max_rowid is None:
+                return None
+
+            await cr.execute(_SELECT_STATE_AT, (random.randint(1, max_rowid),))
+            row = await cr.fetchone()
+
+        return _key_state(row[0]) if row is not None else None
+
+    async def seed_state(self, words: t.Sequence[str]) -> t.Optional[State]:
+        """Picks a random state containing one of the given words, if there is any."""
+        async with self.conn.cursor() as cr:
+            for word in _seed_candidates(words):
+                key = random.randint(0, _MAX_ROWID)
+                await cr.execute(_SELECT_WORD_STATE_AT, (word, key))
+                row = await cr.fetchone()
+                if row is None:
+                    await cr.execute(_SELECT_FIRST_WORD_STATE, (word,))
+                    row = await cr.fetchone()
+
+                if row is not None:
+                    return _key_state(row[0])
+
+        return None
+
     async def trim_messages(
         self,
         *,
         before: t.Union[datetime.datetime, datetime.timedelta],
-    ) -> None:
+        limit: t.Optional[int] = None,
+    ) -> t.Tuple[int, set[State]]:
         """
         Trims messages stored in the database before a specified datetime or timedelta.
 
@@ -124,6 +842,14 @@ class MarkovDB(DBProtocol):
 
                 . If a timedelta object is provided, messages older than timedelta from the current datetime will be deleted.
 
+            limit (`Optional[int]`):
+                The maximum amount of messages to delete, oldest first. Every message
+                older than the threshold is deleted if it's not provided.
+
+        Returns:
+        --------
+            `Tuple[int, set[State]]`: The amount of deleted messages and the states whose transitions were changed.
+
         Raises:
         -------
             `ValueError`: If an invalid 'before' argument is provided.
@@ -139,59 +865,420 @@ class MarkovDB(DBProtocol):
                 "Invalid 'before' argument. Expected datetime.datetime or datetime.timedelta."
             )
 
+        async with self.conn.cursor(transaction=True) as cr:
+            await cr.execute(
+                """
+                SELECT rowid, message FROM messages WHERE timestamp < ?
+                ORDER BY timestamp LIMIT ?
+                """,
+                (threshold_datetime, -1 if limit is None else limit),
+            )
+            rows = await cr.fetchall()
+            return await self._delete_messages(cr, rows)
+
+    async def _delete_messages(
+        self,
+        cr: asqlite.Cursor,
+        rows: t.Sequence[t.Tuple[int, str]],
+    ) -> t.Tuple[int, set[State]]:
+        if not rows:
+            return 0, set()
+
+        counts = _count_transitions((row[1] for row in rows), self.state_size)
+        await self._apply_transitions(cr, counts, sign=-1)
+        await cr.executemany(
+            "DELETE FROM messages WHERE rowid = ?",
+            [(row[0],) for row in rows],
+        )
+        await cr.execute(_BUMP_DELETIONS)
+
+        return len(rows), {state for state, _ in counts}
+
+    async def over_budget(self) -> int:
+        """The amount of messages to evict to fit in `max_messages` and `max_bytes`.
+
+        The size is the space taken by the stored data, not the size of the
+        file. Pages left partly empty by a deletion are filled again by later
+        inserts, counting them would make every pass evict more to make up for
+        space that's already free. What a message takes is estimated from the
+        average, what's evicted is only given back to the filesystem once the
+        database is compacted.
+        """
         async with self.conn.cursor() as cr:
+            await cr.execute("SELECT COUNT(*) FROM messages")
+            (n_messages,) = await cr.fetchone()
+
+            excess = 0
+            if self.max_messages is not None:
+                excess = n_messages - self.max_messages
+
+            if self.max_bytes is not None and n_messages:
+                used = await self._used_bytes(cr)
+                if used > self.max_bytes:
+                    per_message = used / n_messages
+                    excess = max(excess, math.ceil((used - self.max_bytes) / per_message))
+
+        return max(excess, 0)
+
+    async def _used_bytes(self, cr: asqlite.Cursor) -> int:
+        try:
+            await cr.execute("SELECT SUM(pgsize - unused) FROM dbstat")
+        except sqlite3.OperationalError:
+            # SQLite built without the dbstat table
+            await cr.execute(_ESTIMATE_USED_BYTES)
+
+        (used,) = await cr.fetchone()
+        return used or 0
+
+    async def evict_messages(self, count: int) -> t.Tuple[int, set[State]]:
+        """Deletes up to `count` messages, the least informative and oldest first.
+
+        A message with no more words than a state adds no transition to the
+        chain, those go before everything else.
+
+        Returns:
+        --------
+            `Tuple[int, set[State]]`: The amount of deleted messages and the states whose transitions were changed.
+        """
+        async with self.conn.cursor(transaction=True) as cr:
             await cr.execute(
-                "DELETE FROM messages WHERE timestamp < ?",
-                (threshold_datetime,),
+                """
+                SELECT rowid, message FROM messages ORDER BY
+                    LENGTH(message) - LENGTH(REPLACE(message, ' ', '')) >= ?,
+                    timestamp
+                LIMIT ?
+                """,
+                (self.state_size, count),
             )
-            await self.conn.commit()
+            rows = await cr.fetchall()
+            return await self._delete_messages(cr, rows)
+
+    async def compact(self, *, min_free: float = 0.25) -> int:
+        """Gives the free pages back to the filesystem with an incremental vacuum.
+
+        Nothing is done unless at least `min_free` of the pages are free.
+
+        Returns:
+        --------
+            `int`: The amount of pages given back.
+        """
+        async with self.conn.cursor() as cr:
+            await cr.execute("PRAGMA page_count")
+            (page_count,) = await cr.fetchone()
+            await cr.execute("PRAGMA freelist_count")
+            (free_pages,) = await cr.fetchone()
+            if not free_pages or free_pages < page_count * min_free:
+                return 0
+
+            # A single step of the pragma frees a single page, only a script
+            # runs it to completion. The checkpoint then shrinks the file.
+            await cr.executescript("PRAGMA incremental_vacuum")
+            await cr.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        return free_pages
+
+
+class ChainCache:
+    """A bounded, least-recently-used cache of the transitions of each state.
+
+    States are loaded from the database the first time they are needed and kept
+    up to date by `add_transitions`, so a long-lived model doesn't need to hit the
+    database again for the states it already knows. States touched by a trim are
+    dropped and reloaded on their next use.
+    """
+
+    def __init__(self, *, max_transitions: int = 250_000) -> None:
+        self.max_transitions = max_transitions
+
+        self._states: OrderedDict[State, Transitions] = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __contains__(self, state: object) -> bool:
+        return state in self._states
+
+    @property
+    def size(self) -> int:
+        """The amount of transitions currently held by the cache"""
+        return self._size
+
+    @staticmethod
+    def _weight(followers: Transitions) -> int:
+        # Dead ends are cached as well, count them so they can't grow unbounded
+        return len(followers) or 1
+
+    def get(self, state: State) -> t.Optional[Transitions]:
+        followers = self._states.get(state)
+        if followers is not None:
+            self._states.move_to_end(state)
+
+        return followers
+
+    def put(self, state: State, followers: Transitions) -> None:
+        self.invalidate((state,))
+
+        self._states[state] = followers
+        self._size += self._weight(followers)
+        self._evict()
+
+    def add_transitions(self, counts: TransitionCounts) -> None:
+        """Updates the cached states with newly stored transitions.
+
+        States that are not cached are ignored, they will be read from the
+        database, already up to date, the next time they are needed.
+        """
+        for (state, word), count in counts.items():
+            followers = self._states.get(state)
+            if followers is None:
+                continue
+
+            self._size -= self._weight(followers)
+            followers.add(word, count)
+            self._size += self._weight(followers)
+
+        self._evict()
+
+    def invalidate(self, states: t.Iterable[State]) -> None:
+        for state in states:
+            followers = self._states.pop(state, None)
+            if followers is not None:
+                self._size -= self._weight(followers)
+
+    def clear(self) -> None:
+        self._states.clear()
+        self._size = 0
+
+    def _evict(self) -> None:
+        while self._size > self.max_transitions and self._states:
+            _, followers = self._states.popitem(last=False)
+            self._size -= self._weight(followers)
 
 
 class MarkovModel:
     db: DBProtocol
+    cache: t.Optional[ChainCache]
+    pool: t.Optional[SentencePool]
 
-    def __init__(self, db: t.Optional[DBProtocol] = None) -> None:
+    def __init__(
+        self,
+        db: t.Optional[DBProtocol] = None,
+        *,
+        state_size: int = 1,
+        cache: t.Optional[ChainCache] = None,
+        flush_every: int = 1,
+        flush_interval: float = 0.0,
+        executor: ExecutorMode = "inline",
+        max_concurrency: int = 2,
+        timeout: t.Optional[float] = None,
+        pool_size: int = 0,
+        pool_low_water: int = 1,
+        snapshot_path: t.Optional[t.Union[str, pathlib.Path]] = None,
+        candidates: int = 1,
+        dedup: t.Optional[NearDuplicateFilter] = None,
+    ) -> None:
         if db is None:
-            db = MarkovDB()
+            db = MarkovDB(state_size=state_size)
 
         self.db = db
+        self.cache = cache
 
-    def _process_text(self, body: str) -> str:
-        body = body.translate(
-            str.maketrans("", "", string.punctuation),
-        )
-        return body
+        # Stored messages are buffered and written together once `flush_every`
+        # of them are pending, or `flush_interval` seconds after the first one.
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending: list[str] = []
+        self._flush_task: t.Optional[asyncio.Task[None]] = None
+
+        # Near-duplicates of recently stored messages are never buffered
+        self.dedup = dedup
+
+        # The model may be long-lived and shared by concurrent replies, but
+        # the database holds a single connection at a time.
+        self._lock = asyncio.Lock()
+
+        # "inline" generates on the event loop using the cache, "thread" and
+        # "process" move the whole generation to an executor. In every mode at
+        # most `max_concurrency` generations run at once, and the ones taking
+        # longer than `timeout` seconds are given up.
+        self.executor_mode: ExecutorMode = executor
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._executor: t.Optional[futures.Executor] = None
+        if executor == "thread":
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=max_concurrency,
+                thread_name_prefix="markov",
+            )
+        elif executor == "process":
+            # Forking a process already running the asqlite and discord.py
+            # threads can deadlock the child, the workers start from scratch
+            self._executor = futures.ProcessPoolExecutor(
+                max_workers=max_concurrency,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        # Every text is the best of `candidates` generated together
+        self.candidates = candidates
+
+        self.pool = None
+        if pool_size > 0:
+            self.pool = SentencePool(self, size=pool_size, low_water=pool_low_water)
+
+        # The snapshot is mapped the first time the model generates something.
+        # Transitions learned since it was saved live in `_delta`, and the
+        # states touched by a trim since then are read from the database.
+        self.snapshot_path = pathlib.Path(snapshot_path) if snapshot_path else None
+        self._snapshot: t.Optional[Chain] = None
+        self._snapshot_checked = False
+        self._delta: dict[State, Transitions] = {}
+        self._stale: set[State] = set()
+
+    @contextlib.asynccontextmanager
+    async def _acquire_db(self) -> t.AsyncIterator[DBProtocol]:
+        async with self._lock, self.db as db:
+            yield db
+
+    @property
+    def state_size(self) -> int:
+        return self.db.state_size
 
     def _create_chain(self, words: list[str], state_size: int = 1) -> Chain:
-        chain: Chain = defaultdict(list)
+        return Chain.from_words(words, state_size)
 
-        for current_state, next_word in zip(words, words[state_size:]):
-            if next_word not in chain[current_state]:
-                chain[current_state].append(next_word)
+    async def _fetch_followers(
+        self,
+        db: DBProtocol,
+        chain: Chain,
+        state: State,
+    ) -> Transitions:
+        followers = self.cache.get(state) if self.cache is not None else None
+        if followers is None:
+            followers = self._snapshot_followers(state)
+            if followers is None:
+                followers = Transitions(await db.fetch_transitions(state))
 
-        return chain
+            if self.cache is not None:
+                self.cache.put(state, followers)
 
-    def _generate_text(self, chain: Chain, n_words: int) -> str:
-        first_word = random.choice(list(chain.keys()))
-        generated_words = [first_word]
+        extra = chain.get(state)
+        if extra is not None:
+            followers = followers.merged(extra)
 
-        for _ in range(n_words - 1):
-            current_word = generated_words[-1]
-            if not chain.get(current_word):
-                continue
+        return followers
+
+    def _snapshot_followers(self, state: State) -> t.Optional[Transitions]:
+        if self._snapshot is None or state in self._stale:
+            return None
+
+        followers = self._snapshot.get(state) or Transitions()
+        delta = self._delta.get(state)
+        if delta is not None:
+            followers = followers.merged(delta)
+
+        return followers
+
+    def _add_delta(self, counts: TransitionCounts) -> None:
+        for (state, word), count in counts.items():
+            followers = self._delta.get(state)
+            if followers is None:
+                followers = self._delta[state] = Transitions()
+
+            followers.add(word, count)
+
+    async def _load_snapshot(self, db: DBProtocol) -> None:
+        self._snapshot_checked = True
+        if self.snapshot_path is None:
+            return
+
+        try:
+            snapshot = Snapshot.load(self.snapshot_path)
+        except (OSError, ValueError):
+            return
+
+        # A trim since the snapshot was saved makes it useless, there is no way
+        # of knowing which transitions the deleted messages had. Counting the
+        # messages isn't enough, the rowid of a deleted last message is reused.
+        n_messages = await db.count_messages(until=snapshot.last_rowid)
+        if (
+            snapshot.chain.state_size != self.state_size
+            or n_messages != snapshot.n_messages
+            or await db.deletions() != snapshot.deletions
+        ):
+            return
+
+        delta: TransitionCounts = Counter()
+        async for rows in db.iter_messages(after=snapshot.last_rowid):
+            delta.update(_count_transitions((row[0] for row in rows), self.state_size))
+
+        self._snapshot = snapshot.chain
+        self._delta.clear()
+        self._stale.clear()
+        self._add_delta(delta)
+
+    async def save_snapshot(self) -> None:
+        """Saves the chain of the whole corpus to `snapshot_path` and maps it.
 
-            next_word = random.choice(chain[current_word])
-            generated_words.append(next_word)
+        The chain is built a batch of messages at a time, see `load_chain`.
+        """
+        if self.snapshot_path is None:
+            return
+
+        builder = ChainBuilder(self.state_size)
+        async with self._acquire_db() as db:
+            last_rowid = await db.last_rowid()
+            n_messages = await db.count_messages(until=last_rowid)
+            deletions = await db.deletions()
+            async for rows in db.iter_messages(until=last_rowid):
+                for row in rows:
+                    builder.feed(row[0].split())
 
-        return " ".join(generated_words)
+        snapshot = Snapshot(builder.build(), last_rowid, n_messages, deletions)
+        await asyncio.to_thread(snapshot.save, self.snapshot_path)
 
-    async def generate_text(self, input: str, n_words: int) -> str:
+        # Whatever was learned or trimmed meanwhile is caught up by the replay
+        async with self._acquire_db() as db:
+            await self._load_snapshot(db)
+
+    async def _generate_text(
+        self,
+        db: DBProtocol,
+        chain: Chain,
+        n_words: int,
+        seed: t.Sequence[str] = (),
+        candidates: int = 1,
+    ) -> str:
+        return await _generate_candidates(
+            functools.partial(self._fetch_followers, db, chain),
+            db.random_state,
+            db.seed_state,
+            n_words=n_words,
+            state_size=self.state_size,
+            seed=seed,
+            candidates=candidates,
+        )
+
+    async def generate_text(
+        self,
+        input: str,
+        n_words: int,
+        *,
+        candidates: t.Optional[int] = None,
+    ) -> str:
         """Generates a text based on the given input and the messages stored in the database.
 
+        Only the transitions of the words being generated are read from the database,
+        so the cost of a reply does not depend on the size of the corpus. The text
+        starts from a state containing one of the input words when possible.
+
         Parameters:
         -----------
             input (`str`): The input text to use as a starting point for generating the text.
             n_words (`int`): The number of words to generate in the output text.
+            candidates (`Optional[int]`):
+                How many texts are generated together, only the best one is returned.
+                Defaults to the `candidates` given to the model.
 
         Returns:
         --------
@@ -200,39 +1287,482 @@ class MarkovModel:
         Raises:
         -------
             `ValueError`: If the database does not contain any entries.
+            `sqlite3.OperationalError`: If an executor can't open the database file.
+            `GenerationSkipped`: If every generation slot is busy or the generation timed out.
 
-        """        
-        text = self._process_text(input)
-        words = text.lower().split(" ")
+        """
+        seed = tokenize(input)
+        chain = self._create_chain(seed, self.state_size)
+        candidates = candidates or self.candidates
 
-        rows = await self.fetch_messages()
-        if rows is None:
-            raise ValueError("The database does not contains any entries")
+        # Skip instead of queueing, a late reply is worse than no reply
+        if self._slots.locked():
+            raise GenerationSkipped("Every generation slot is busy")
 
-        for row in rows:
-            words.extend(row[0].split(" "))
+        await self._slots.acquire()
+        if self._executor is None:
+            task = asyncio.ensure_future(
+                self._generate_inline(chain, n_words, seed, candidates)
+            )
+        else:
+            loop = asyncio.get_running_loop()
+            func = functools.partial(
+                _generate_from_file,
+                self.db.path.as_posix(),
+                self.state_size,
+                chain,
+                n_words,
+                seed,
+                candidates,
+            )
+            task = loop.run_in_executor(self._executor, func)
 
-        chain = self._create_chain(words)
+        # An executor job can't be interrupted, its slot is only given back
+        # once it really finishes, even if it already timed out.
+        task.add_done_callback(self._release_slot)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            if self._executor is None:
+                task.cancel()
+
+            raise GenerationSkipped(
+                f"The generation took more than {self.timeout} seconds"
+            ) from None
+
+    async def pooled_text(self, input: str, n_words: int) -> str:
+        """Returns a pre-generated text from the pool when the input has no words.
+
+        Pooled texts are not seeded, so an input with words always gets a text of
+        `n_words` words seeded by it, generated right away. So does an empty
+        input when the pool is empty or the model has none.
+
+        Raises:
+        -------
+            `ValueError`: If the database does not contain any entries.
+            `sqlite3.OperationalError`: If an executor can't open the database file.
+            `GenerationSkipped`: If every generation slot is busy or the generation timed out.
+        """
+        text = None
+        if self.pool is not None and not tokenize(input):
+            text = self.pool.pop()
+
+        if text is None:
+            text = await self.generate_text(input, n_words)
+
+        return text
+
+    def _release_slot(self, future: asyncio.Future[str]) -> None:
+        self._slots.release()
+        if not future.cancelled():
+            # Mark the exception as retrieved, the caller may have given up on it
+            future.exception()
+
+    async def _generate_inline(
+        self,
+        chain: Chain,
+        n_words: int,
+        seed: t.Sequence[str],
+        candidates: int,
+    ) -> str:
+        async with self._acquire_db() as db:
+            if not self._snapshot_checked:
+                await self._load_snapshot(db)
 
-        ret = self._generate_text(chain, n_words)
-        del chain
-        return ret
+            return await self._generate_text(db, chain, n_words, seed, candidates)
+
+    def close(self) -> None:
+        """Stops refilling the pool and shuts down the generation executor, if any."""
+        if self.pool is not None:
+            self.pool.close()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
     async def store_message(self, msg: str):
-        async with self.db as db:
-            await db.add_message(msg)
+        """Buffers a message to be learned, unless it has no tokens or is a near-duplicate.
+
+        The message is tokenized right away, the buffer only holds normalised text.
+        """
+        tokens = tokenize(msg)
+        if not tokens:
+            return
+
+        if self.dedup is not None and self.dedup.is_duplicate(tokens):
+            return
+
+        self._pending.append(" ".join(tokens))
+        if len(self._pending) >= self.flush_every:
+            await self.flush()
+
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+
+        # Past this point the flush must not be cancelled by another one
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Writes every buffered message to the database in a single transaction."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        try:
+            await self._write(pending)
+        except Exception:
+            self._pending[:0] = pending
+            raise
+
+    async def import_messages(
+        self,
+        msgs: t.Sequence[str],
+        *,
+        timestamps: t.Optional[t.Sequence[datetime.datetime]] = None,
+        metadata: t.Optional[t.Mapping[str, t.Any]] = None,
+    ) -> int:
+        """Learns a batch of messages right away, in a single transaction.
+
+        Unlike `store_message` nothing is buffered, which suits bulk imports.
+        Messages without tokens and near-duplicates are skipped the same way.
+
+        Parameters:
+        -----------
+            msgs (`Sequence[str]`): The messages to learn.
+            timestamps (`Optional[Sequence[datetime.datetime]]`): When each
+                message was sent, so retention and eviction treat old messages
+                as old.
+            metadata (`Optional[Mapping[str, Any]]`): Metadata stored in the
+                same transaction as the messages, like the progress of an
+                import, so it never disagrees with what was stored.
+
+        Returns:
+        --------
+            `int`: The amount of messages stored.
+        """
+        if timestamps is not None and len(timestamps) != len(msgs):
+            raise ValueError("Every message needs a timestamp")
+
+        normalized: list[str] = []
+        kept_timestamps: list[datetime.datetime] = []
+        for i, tokens in enumerate(tokenize_many(msgs)):
+            if not tokens:
+                continue
+
+            if self.dedup is not None and self.dedup.is_duplicate(tokens):
+                continue
+
+            normalized.append(" ".join(tokens))
+            if timestamps is not None:
+                kept_timestamps.append(timestamps[i])
+
+        if not normalized and not metadata:
+            return 0
+
+        msgs = await self._write(
+            normalized,
+            timestamps=kept_timestamps if timestamps is not None else None,
+            metadata=metadata,
+        )
+        return len(msgs)
+
+    async def _write(
+        self,
+        normalized: list[str],
+        *,
+        timestamps: t.Optional[list[datetime.datetime]] = None,
+        metadata: t.Optional[t.Mapping[str, t.Any]] = None,
+    ) -> list[str]:
+        async with self._acquire_db() as db:
+            msgs = await db.add_messages(
+                normalized, normalized=True, timestamps=timestamps, metadata=metadata
+            )
+
+        if not msgs:
+            return msgs
+
+        if self.cache is not None or self._snapshot is not None:
+            counts = _count_transitions(msgs, self.state_size)
+            if self.cache is not None:
+                self.cache.add_transitions(counts)
+
+            if self._snapshot is not None:
+                self._add_delta(counts)
+
+        # New messages don't make the pooled texts wrong, only a little dated,
+        # so just the oldest ones are replaced
+        if self.pool is not None:
+            self.pool.refill(replace=self.pool.refresh)
+
+        return msgs
+
+    async def oldest_message(self) -> t.Optional[datetime.datetime]:
+        """When the oldest learned message was sent, buffered messages included."""
+        await self.flush()
+        async with self._acquire_db() as db:
+            return await db.oldest_message()
+
+    async def get_metadata(self, key: str) -> t.Any:
+        async with self._acquire_db() as db:
+            return await db.get_metadata(key)
+
+    async def set_metadata(self, key: str, value: t.Any) -> None:
+        async with self._acquire_db() as db:
+            await db.set_metadata(key, value)
 
     async def fetch_messages(self):
-        async with self.db as db:
+        async with self._acquire_db() as db:
             result = await db.fetch_messages()
 
-        await self.trim_messages(before=datetime.timedelta(days=1))
         return result
 
+    async def load_chain(self, batch_size: int = _MESSAGES_BATCH_SIZE) -> Chain:
+        """Builds the packed chain of the whole corpus, reading it a batch at a time.
+
+        Only the chain being built and a single batch of messages are in memory
+        at once, never the whole corpus or its list of words.
+        """
+        builder = ChainBuilder(self.state_size)
+        async with self._acquire_db() as db:
+            async for rows in db.iter_messages(batch_size):
+                for row in rows:
+                    builder.feed(row[0].split())
+
+        return builder.build()
+
     async def trim_messages(
         self,
         *,
         before: t.Union[datetime.datetime, datetime.timedelta],
-    ):
-        async with self.db as db:
-            return await db.trim_messages(before=before)
+        chunk_size: t.Optional[int] = None,
+    ) -> int:
+        """Trims the messages stored before the given threshold.
+
+        When `chunk_size` is given, messages are deleted in transactions of at
+        most that many rows, letting replies and writes run in between them.
+
+        Returns:
+        --------
+            `int`: The amount of deleted messages.
+        """
+        if isinstance(before, datetime.timedelta):
+            # Every chunk must use the same threshold
+            before = datetime.datetime.now() - before
+
+        total = 0
+        while True:
+            async with self._acquire_db() as db:
+                deleted, states = await db.trim_messages(before=before, limit=chunk_size)
+
+            self._forget(states)
+            total += deleted
+            if chunk_size is None or deleted < chunk_size:
+                break
+
+        if total and self.pool is not None:
+            self.pool.refill(stale=True)
+
+        return total
+
+    async def enforce_budget(self, *, chunk_size: t.Optional[int] = None) -> int:
+        """Evicts messages until the database fits in its storage budget, then compacts it.
+
+        Like `trim_messages`, messages are deleted in transactions of at most
+        `chunk_size` rows when it's given.
+
+        Returns:
+        --------
+            `int`: The amount of evicted messages.
+        """
+        async with self._acquire_db() as db:
+            excess = await db.over_budget()
+
+        total = 0
+        while total < excess:
+            limit = excess - total
+            if chunk_size is not None:
+                limit = min(limit, chunk_size)
+
+            async with self._acquire_db() as db:
+                deleted, states = await db.evict_messages(limit)
+
+            self._forget(states)
+            total += deleted
+            if deleted < limit:
+                break
+
+        if total:
+            async with self._acquire_db() as db:
+                await db.compact()
+
+            if self.pool is not None:
+                self.pool.refill(stale=True)
+
+        return total
+
+    def _forget(self, states: set[State]) -> None:
+        """Drops whatever is kept in memory about states changed by a deletion."""
+        if self.cache is not None:
+            self.cache.invalidate(states)
+
+        if self._snapshot is not None:
+            self._stale |= states
+
+
+class SentencePool:
+    """A bounded pool of texts generated ahead of time by a `MarkovModel`.
+
+    The pool is refilled by a background task once it drains below `low_water`
+    texts, and regenerated when messages are deleted. Being a bounded deque,
+    the fresh texts push the oldest ones out, which is how `refresh` texts are
+    replaced every time new messages are learned.
+
+    Parameters:
+    -----------
+        model (`MarkovModel`): The model generating the texts.
+        size (`int`): The maximum amount of texts kept in the pool.
+        low_water (`int`): The pool is refilled when it has less texts than this.
+        n_words (`Tuple[int, int]`): The range of the amount of words of each text.
+        refresh (`int`): The amount of texts replaced when new messages are learned.
+    """
+
+    def __init__(
+        self,
+        model: MarkovModel,
+        *,
+        size: int = 20,
+        low_water: int = 1,
+        n_words: t.Tuple[int, int] = (6, 12),
+        refresh: int = 1,
+    ) -> None:
+        self.model = model
+        self.size = size
+        self.low_water = low_water
+        self.n_words = n_words
+        self.refresh = refresh
+
+        self._texts: deque[str] = deque(maxlen=size)
+        self._missing = 0
+        self._refill_task: t.Optional[asyncio.Task[None]] = None
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def random_length(self) -> int:
+        return random.randint(*self.n_words)
+
+    def pop(self) -> t.Optional[str]:
+        """Takes the oldest text out of the pool, if there is any."""
+        text = self._texts.popleft() if self._texts else None
+        if len(self._texts) < self.low_water:
+            self.refill()
+
+        return text
+
+    def refill(self, *, stale: bool = False, replace: int = 0) -> None:
+        """Refills the pool in the background.
+
+        When `stale` is true every text in the pool is replaced, otherwise
+        the missing ones are generated along with `replace` more, pushing the
+        oldest ones out.
+        """
+        missing = self.size if stale else min(self.size, self.size - len(self._texts) + replace)
+        self._missing = max(self._missing, missing)
+
+        if self._missing > 0 and self._refill_task is None:
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self) -> None:
+        try:
+            while self._missing > 0:
+                try:
+                    text = await self.model.generate_text("", self.random_length())
+                except (GenerationSkipped, ValueError):
+                    # Busy or empty, try again the next time the pool is used
+                    break
+
+                self._texts.append(text)
+                self._missing -= 1
+        finally:
+            self._refill_task = None
+
+    def close(self) -> None:
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+
+
+class MarkovShards:
+    """The Markov models of every shard of the corpus, usually one per channel.
+
+    Each shard is stored in its own database file inside `directory`, and its
+    model is only created (and its file only opened) the first time it's used,
+    so a reply never reads the history of the other shards.
+
+    Parameters:
+    -----------
+        directory (`Union[str, pathlib.Path]`): The directory holding a database per shard.
+        factory (`Callable[[MarkovDB], MarkovModel]`): Creates the model of a shard from its database.
+        state_size (`int`): The state size of every shard.
+        max_messages (`Optional[int]`): The maximum amount of messages of each shard.
+        max_bytes (`Optional[int]`): The maximum size of the database of each shard.
+    """
+
+    def __init__(
+        self,
+        directory: t.Union[str, pathlib.Path] = "./data/markov",
+        *,
+        factory: t.Callable[[MarkovDB], MarkovModel] = MarkovModel,
+        state_size: int = 1,
+        max_messages: t.Optional[int] = None,
+        max_bytes: t.Optional[int] = None,
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.factory = factory
+        self.state_size = state_size
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._models: dict[int, MarkovModel] = {}
+
+    def path_for(self, shard_id: int) -> pathlib.Path:
+        return self.directory / f"{shard_id}.db"
+
+    def get(self, shard_id: int) -> MarkovModel:
+        """Returns the model of a shard, creating it if needed."""
+        model = self._models.get(shard_id)
+        if model is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            db = MarkovDB(
+                self.path_for(shard_id),
+                state_size=self.state_size,
+                max_messages=self.max_messages,
+                max_bytes=self.max_bytes,
+            )
+            model = self._models[shard_id] = self.factory(db)
+
+        return model
+
+    def __contains__(self, shard_id: int) -> bool:
+        return shard_id in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __iter__(self) -> t.Iterator[MarkovModel]:
+        return iter(list(self._models.values()))
+
+    async def flush(self) -> None:
+        """Writes the buffered messages of every loaded shard."""
+        for model in self:
+            await model.flush()
+
+    def close(self) -> None:
+        for model in self:
+            model.close()
@@ -0,0 +1,87 @@
+"""The single tokenization stage of the text learned by the Markov model.
+
+Messages are normalised once, when they are stored, into lowercase tokens
+joined by a single space. Everything reading stored text afterwards only has to
+`str.split` it.
+"""
+from __future__ import annotations
+import typing as t
+
+import functools
+import unicodedata
+import string
+import sys
+import re
+
+__all__ = (
+    "TOKENIZER_VERSION",
+    "normalize",
+    "normalize_many",
+    "tokenize",
+    "tokenize_many",
+)
+
+# Bumped whenever the tokens produced for the same text change, stored text
+# normalised by another version has to be normalised again.
+TOKENIZER_VERSION: t.Final[int] = 1
+
+# Links and mentions are dropped, a reply should never ping or link anyone
+_DROPPED_RE = re.compile(
+    r"https?://\S+"
+    r"|www\.\S+"
+    r"|<(?:@[!&]?|#)\d+>"
+    r"|@(?:everyone|here)\b"
+)
+
+# Custom emojis are kept as a single token, in their original case
+_EMOJI_RE = re.compile(r"(<a?:\w+:\d+>)")
+
+
+@functools.cache
+def _punctuation_table() -> dict[int, None]:
+    """Maps every Unicode punctuation character, and ASCII symbols, to nothing."""
+    table: dict[int, None] = dict.fromkeys(map(ord, string.punctuation))
+    for codepoint in range(sys.maxunicode + 1):
+        if unicodedata.category(chr(codepoint)).startswith("P"):
+            table[codepoint] = None
+
+    return table
+
+
+def _plain_tokens(text: str, table: dict[int, None]) -> list[str]:
+    return text.lower().translate(table).split()
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits a message into normalised tokens.
+
+    Links and mentions are removed, custom emojis are kept untouched and every
+    other token is lowercased and stripped of punctuation. Unicode emojis and
+    accented letters are kept.
+    """
+    table = _punctuation_table()
+    text = _DROPPED_RE.sub(" ", text)
+    if "<" not in text:
+        return _plain_tokens(text, table)
+
+    tokens: list[str] = []
+    for i, part in enumerate(_EMOJI_RE.split(text)):
+        if i % 2:
+            tokens.append(part)
+        else:
+            tokens.extend(_plain_tokens(part, table))
+
+    return tokens
+
+
+def tokenize_many(texts: t.Iterable[str]) -> list[list[str]]:
+    return [tokenize(text) for text in texts]
+
+
+def normalize(text: str) -> str:
+    """The tokens of a message joined by a single space, as it's stored."""
+    return " ".join(tokenize(text))
+
+
+def normalize_many(texts: t.Iterable[str]) -> list[str]:
+    return [" ".join(tokens) for tokens in tokenize_many(texts)]
@@ -0,0 +1,34 @@
+from __future__ import annotations
+import typing as t
+
+import pathlib
+
+import pytest
+
+from extensions.utils import database
+
+
+@pytest.fixture
+def data_dir(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> pathlib.Path:
+    """A temporary working directory with an empty `data/` directory inside of it.
+
+    `Database` keeps its files under `./data`, so nothing touches the real one.
+    The schema registry is replaced too, it remembers tables by their path.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "schema_registry", database.SchemaRegistry())
+    path = tmp_path / "data"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def messages() -> t.List[str]:
+    return [
+        "o gato subiu no telhado",
+        "o gato desceu do telhado de novo",
+        "que dia bonito pra subir no telhado",
+        "o cachorro latiu pro gato",
+        "bom dia",
+        "o gato subiu no telhado",
+    ]
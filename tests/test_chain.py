@@ -0,0 +1,63 @@
+from __future__ import annotations
+import typing as t
+
+import pathlib
+
+import pytest
+
+from extensions.utils.chain import ChainBuilder, Snapshot
+
+
+def _build(messages: t.List[str], state_size: int) -> ChainBuilder:
+    builder = ChainBuilder(state_size)
+    for msg in messages:
+        builder.feed(msg.split())
+
+    return builder
+
+
+@pytest.mark.parametrize("state_size", [1, 2])
+def test_snapshot_round_trip(
+    tmp_path: pathlib.Path, messages: t.List[str], state_size: int
+) -> None:
+    chain = _build(messages, state_size).build()
+    path = tmp_path / "markov.snapshot"
+    Snapshot(chain, 42, len(messages), 3).save(path)
+
+    loaded = Snapshot.load(path)
+    assert loaded.last_rowid == 42
+    assert loaded.n_messages == len(messages)
+    assert loaded.deletions == 3
+    assert loaded.chain.state_size == state_size
+    assert len(loaded.chain) == len(chain)
+    assert list(loaded.chain.vocabulary) == list(chain.vocabulary)
+
+    for msg in messages:
+        words = msg.split()
+        for i in range(len(words) - state_size):
+            state = tuple(words[i : i + state_size])
+            expected = chain.get(state)
+            followers = loaded.chain.get(state)
+            assert expected is not None and followers is not None
+            assert followers.counts == expected.counts
+
+    assert loaded.chain.get(("inexistente",) * state_size) is None
+
+
+def test_snapshot_load_rejects_other_files(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "markov.snapshot"
+    path.write_bytes(b"not a snapshot" * 10)
+
+    with pytest.raises(ValueError):
+        Snapshot.load(path)
+
+
+def test_snapshot_load_rejects_truncated_files(
+    tmp_path: pathlib.Path, messages: t.List[str]
+) -> None:
+    path = tmp_path / "markov.snapshot"
+    Snapshot(_build(messages, 1).build(), 0, 0, 0).save(path)
+    path.write_bytes(path.read_bytes()[:-16])
+
+    with pytest.raises(ValueError):
+        Snapshot.load(path)
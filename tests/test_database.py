@@ -0,0 +1,105 @@
+from __future__ import annotations
+import typing as t
+
+import asyncio
+import pathlib
+
+import pytest
+
+from extensions.utils.database import Database, DataType, close_pools
+
+COLUMNS: t.Final[dict[str, DataType]] = {
+    "user_id": DataType.INTEGER,
+    "reason": DataType.TEXT,
+}
+
+
+async def _user_ids(db: Database) -> t.List[int]:
+    return sorted(row[0] for row in await db.select("user_id").execute())
+
+
+def test_transaction_rolls_back_the_failed_savepoint_only(data_dir: pathlib.Path) -> None:
+    async def run() -> None:
+        try:
+            async with Database("savepoints", columns=COLUMNS) as db:
+                async with db.transaction():
+                    await db.insert(user_id=1, reason="kept")
+                    with pytest.raises(RuntimeError):
+                        async with db.transaction():
+                            await db.insert(user_id=2, reason="rolled back")
+                            raise RuntimeError
+
+                    await db.insert(user_id=3, reason="kept")
+
+                assert await _user_ids(db) == [1, 3]
+        finally:
+            await close_pools()
+
+    asyncio.run(run())
+
+
+def test_transaction_rolls_back_everything_on_error(data_dir: pathlib.Path) -> None:
+    async def run() -> None:
+        try:
+            async with Database("rollbacks", columns=COLUMNS) as db:
+                with pytest.raises(RuntimeError):
+                    async with db.transaction():
+                        await db.insert(user_id=1, reason="rolled back")
+                        async with db.transaction():
+                            await db.insert(user_id=2, reason="rolled back")
+                        raise RuntimeError
+
+                assert await _user_ids(db) == []
+        finally:
+            await close_pools()
+
+    asyncio.run(run())
+
+
+def test_insert_many_inserts_every_row(data_dir: pathlib.Path) -> None:
+    async def rows() -> t.AsyncIterator[dict[str, t.Any]]:
+        for user_id in range(10, 15):
+            yield {"user_id": user_id, "reason": "async"}
+
+    async def run() -> None:
+        try:
+            async with Database("bulk", columns=COLUMNS) as db:
+                sync_rows = ({"user_id": i, "reason": "sync"} for i in range(5))
+                assert await db.insert_many(sync_rows) == 5
+                assert await db.insert_many(rows()) == 5
+                assert await db.insert_many([]) == 0
+                assert await _user_ids(db) == [*range(5), *range(10, 15)]
+        finally:
+            await close_pools()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "bad_row",
+    [
+        {"user_id": 2, "reason": object()},
+        {"user_id": 2},
+    ],
+    ids=["not serializable", "other columns"],
+)
+def test_insert_many_rolls_back_on_a_bad_row(
+    data_dir: pathlib.Path, bad_row: dict[str, t.Any]
+) -> None:
+    async def run() -> None:
+        try:
+            async with Database("bulk_rollback", columns=COLUMNS) as db:
+                rows = [
+                    {"user_id": 0, "reason": "ok"},
+                    {"user_id": 1, "reason": "ok"},
+                    bad_row,
+                    {"user_id": 3, "reason": "ok"},
+                ]
+                with pytest.raises(ValueError):
+                    await db.insert_many(rows)
+
+                assert await _user_ids(db) == []
+        finally:
+            await close_pools()
+
+    asyncio.run(run())
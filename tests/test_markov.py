@@ -0,0 +1,116 @@
+from __future__ import annotations
+import typing as t
+
+import asyncio
+import datetime
+import pathlib
+
+import pytest
+
+from extensions.utils.markov import MarkovDB, _count_transitions
+
+
+async def _table(db: MarkovDB, query: str) -> t.List[t.Tuple[t.Any, ...]]:
+    async with db.conn.cursor() as cr:
+        await cr.execute(query)
+        return sorted(tuple(row) for row in await cr.fetchall())
+
+
+async def _transitions(db: MarkovDB) -> t.List[t.Tuple[t.Any, ...]]:
+    return await _table(db, "SELECT state, next_word, count FROM transitions")
+
+
+async def _state_words(db: MarkovDB) -> t.List[t.Tuple[t.Any, ...]]:
+    return await _table(db, "SELECT word, state FROM state_words")
+
+
+@pytest.mark.parametrize("state_size", [1, 2])
+def test_add_messages_counts_transitions(
+    data_dir: pathlib.Path, messages: t.List[str], state_size: int
+) -> None:
+    async def run() -> None:
+        async with MarkovDB(data_dir / "markov.db", state_size=state_size) as db:
+            stored = await db.add_messages(messages)
+            transitions = await _transitions(db)
+            state_words = await _state_words(db)
+
+        expected = _count_transitions(stored, state_size)
+        assert transitions == sorted(
+            (" ".join(state), word, count) for (state, word), count in expected.items()
+        )
+        assert state_words == sorted(
+            {(word, " ".join(state)) for state, _ in expected for word in state}
+        )
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("state_size", [1, 2])
+def test_trim_messages_empties_every_table(
+    data_dir: pathlib.Path, messages: t.List[str], state_size: int
+) -> None:
+    async def run() -> None:
+        async with MarkovDB(data_dir / "markov.db", state_size=state_size) as db:
+            await db.add_messages(messages)
+            tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+            deleted, _ = await db.trim_messages(before=tomorrow)
+
+            assert deleted == len(messages)
+            assert await db.count_messages() == 0
+            assert await _transitions(db) == []
+            assert await _state_words(db) == []
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("state_size", [1, 2])
+def test_evict_messages_empties_every_table(
+    data_dir: pathlib.Path, messages: t.List[str], state_size: int
+) -> None:
+    async def run() -> None:
+        async with MarkovDB(data_dir / "markov.db", state_size=state_size) as db:
+            await db.add_messages(messages)
+            deleted, _ = await db.evict_messages(len(messages))
+
+            assert deleted == len(messages)
+            assert await db.count_messages() == 0
+            assert await _transitions(db) == []
+            assert await _state_words(db) == []
+
+    asyncio.run(run())
+
+
+def test_rebuild_transitions_matches_incremental_counts(
+    data_dir: pathlib.Path, messages: t.List[str]
+) -> None:
+    async def run() -> None:
+        async with MarkovDB(data_dir / "markov.db", state_size=2) as db:
+            for msg in messages:
+                await db.add_message(msg)
+            await db.evict_messages(2)
+
+            transitions = await _transitions(db)
+            state_words = await _state_words(db)
+            await db.rebuild_transitions()
+
+            assert transitions
+            assert await _transitions(db) == transitions
+            assert await _state_words(db) == state_words
+
+    asyncio.run(run())
+
+
+def test_seed_state_contains_the_seed(
+    data_dir: pathlib.Path, messages: t.List[str]
+) -> None:
+    async def run() -> None:
+        async with MarkovDB(data_dir / "markov.db", state_size=2) as db:
+            await db.add_messages(messages)
+
+            for _ in range(20):
+                state = await db.seed_state(["cachorro"])
+                assert state is not None and "cachorro" in state
+
+            assert await db.seed_state(["inexistente"]) is None
+
+    asyncio.run(run())